@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This writes the state files kept between boots (event store and cache, last frame, refresh state and OAuth token)
+so that a power cut, which is how the Pi usually stops, never leaves a half-written file behind.
+"""
+
+import os
+
+
+def write_atomic(path, data, mode=0o666):
+    """
+    Write data, str or bytes, to path. It is written to path.tmp and flushed to disk first, then moved over path in
+    one step, so path holds either the old or the new contents. mode is the permission of a newly created file,
+    before the umask is applied.
+    """
+    tmpPath = path + '.tmp'
+    fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as tmpFile:
+        tmpFile.write(data)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    os.replace(tmpPath, path)
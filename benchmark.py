@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the slow steps of a calendar refresh.
+
+python3 benchmark.py render compares the imgkit and the native Pillow render backends on a sample month of events.
+Each backend runs in its own process so that the peak RSS reported (including the wkhtmltoimage child for imgkit)
+belongs to that backend only. This is the default when no benchmark is named.
+
+python3 benchmark.py getbuffer times EPD.getbuffer against the per-byte inversion loop it replaced, on 800x480
+frames.
+
+python3 benchmark.py driver runs a full and a partial refresh through the EPD driver on the simulated panel
+(display/simulator.py), and reports the host-side time of each driver call (which includes the simulator's own
+bookkeeping) next to the SPI and BUSY time the simulator models for it.
+"""
+
+import datetime as dt
+import random
+import subprocess
+import sys
+import time
+from pytz import timezone
+from gcal.event import Event
+from metrics.tracer import peak_rss_mb
+
+BACKENDS = ['imgkit', 'pillow']
+ITERATIONS = 20
+
+
+def sample_cal_dict():
+    displayTZ = timezone('America/New_York')
+    today = dt.date(2024, 11, 20)
+    calStartDate = today - dt.timedelta(days=((today.weekday() + 1) % 7))
+    events = []
+    for day in range(35):
+        for n in range(day % 5):
+            start = displayTZ.localize(dt.datetime.combine(calStartDate + dt.timedelta(days=day), dt.time(8 + 2 * n)))
+            events.append(Event('Chore number {} for day {}'.format(n + 1, day + 1), False, start,
+                                start + dt.timedelta(hours=1), start, False, False))
+    return {'events': events, 'calStartDate': calStartDate, 'today': today,
+            'lastRefresh': displayTZ.localize(dt.datetime.combine(today, dt.time(6))), 'batteryLevel': 72.0,
+            'batteryDisplayMode': 1, 'dayOfWeekText': ['M', 'T', 'W', 'T', 'F', 'S', 'S'], 'weekStartDay': 6,
+            'maxEventsPerDay': 3, 'is24hour': False}
+
+
+def run_render(backend):
+    if backend == 'pillow':
+        from render.native import NativeRenderHelper as Helper
+    else:
+        from render.render import RenderHelper as Helper
+    calDict = sample_cal_dict()
+    start = time.perf_counter()
+    Helper(800, 480, 0).process_inputs(calDict)
+    elapsed = time.perf_counter() - start
+    print('{}\t{:.3f}s\t{:.1f} MB'.format(backend, elapsed, peak_rss_mb()))
+
+
+def bench_render():
+    print('backend\twall time\tpeak RSS')
+    for backend in BACKENDS:
+        result = subprocess.run([sys.executable, __file__, 'render', backend], capture_output=True, text=True)
+        if result.returncode != 0:
+            print('{}\tfailed: {}'.format(backend, result.stderr.strip().splitlines()[-1]))
+        else:
+            print(result.stdout.strip())
+
+
+def getbuffer_reference(image):
+    # the packing loop EPD.getbuffer used before, kept to check and time the faster version against
+    buf = bytearray(image.convert('1').tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def time_per_call(func, *args):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(*args)
+    return (time.perf_counter() - start) / ITERATIONS
+
+
+def bench_getbuffer():
+    from PIL import Image
+    from display.epd7in5_V2 import EPD
+    epd = EPD()
+    rng = random.Random(800480)
+    image = Image.frombytes('1', (epd.width, epd.height), bytes(rng.getrandbits(8) for _ in range(48000)))
+    assert epd.getbuffer(image) == getbuffer_reference(image)
+
+    reference = time_per_call(getbuffer_reference, image)
+    current = time_per_call(epd.getbuffer, image)
+    print('getbuffer\tper-byte loop {:.2f}ms\tcurrent {:.2f}ms\t{:.0f}x faster'.format(
+        reference * 1000, current * 1000, reference / current))
+
+
+def bench_driver():
+    from PIL import Image
+    from display import epdconfig
+    from display.epd7in5_V2 import EPD
+    epdconfig.set_backend('simulator')
+    simulator = epdconfig.get_implementation()
+    epd = EPD()
+    rng = random.Random(800480)
+    image = Image.frombytes('1', (epd.width, epd.height), bytes(rng.getrandbits(8) for _ in range(48000)))
+    frame = epd.getbuffer(image)
+    steps = [('init', epd.init), ('Clear', epd.Clear), ('display', epd.display, frame),
+             ('init_part', epd.init_part), ('display_Partial', epd.display_Partial, frame, 0, 0, 400, 240),
+             ('sleep', epd.sleep)]
+
+    print('step\thost time\tSPI\tBUSY and delays')
+    hostTotal = 0
+    for name, func, *args in steps:
+        before = simulator.get_stats()
+        start = time.perf_counter()
+        func(*args)
+        host = time.perf_counter() - start
+        after = simulator.get_stats()
+        hostTotal += host
+        print('{}\t{:.2f}ms\t{:.1f}ms\t{:.2f}s'.format(
+            name, host * 1000, (after['spiSeconds'] - before['spiSeconds']) * 1000,
+            after['busySeconds'] + after['delaySeconds'] - before['busySeconds'] - before['delaySeconds']))
+    print('total\thost {:.2f}ms\tsimulated panel {:.2f}s'.format(
+        hostTotal * 1000, simulator.get_stats()['panelSeconds']))
+
+
+BENCHMARKS = {'render': bench_render, 'getbuffer': bench_getbuffer, 'driver': bench_driver}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'render':
+        run_render(sys.argv[2])
+    elif len(sys.argv) == 2 and sys.argv[1] in BENCHMARKS:
+        BENCHMARKS[sys.argv[1]]()
+    elif len(sys.argv) == 1:
+        bench_render()
+    else:
+        print('usage: benchmark.py [{}]'.format('|'.join(BENCHMARKS)))
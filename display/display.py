@@ -9,11 +9,14 @@ from PIL import Image
 import logging
 
 class DisplayHelper:
-    def __init__(self, width, height):
-        # Initialise the display
+    def __init__(self, width, height, epd=None):
+        # Initialise the display, or wrap an EPD that has already been initialised
         self.logger = logging.getLogger('maginkcal')
         self.screenwidth = width
         self.screenheight = height
+        if epd is not None:
+            self.epd = epd
+            return
         self.epd = eink.EPD()  # Ensure this matches the class name in your driver file
         self.logger.info("Initializing e-paper display.")
         if self.epd.init() != 0:
@@ -30,8 +33,8 @@ class DisplayHelper:
     def calibrate(self, cycles=1):
         # Calibrates the display to prevent ghosting
         self.logger.info("Calibrating the display to prevent ghosting.")
-        white = Image.new('1', (self.screenwidth, self.screenheight), 'white')
-        black = Image.new('1', (self.screenwidth, self.screenheight), 'black')
+        white = self.epd.getbuffer(Image.new('1', (self.screenwidth, self.screenheight), 'white'))
+        black = self.epd.getbuffer(Image.new('1', (self.screenwidth, self.screenheight), 'black'))
         for _ in range(cycles):
             self.epd.display(black)
             self.epd.display(white)
@@ -29,6 +29,7 @@
 
 
 import logging
+import time
 from . import epdconfig
 
 # Display resolution
@@ -40,6 +41,88 @@ GRAY2  = 0xC0
 GRAY3  = 0x80 #gray
 GRAY4  = 0x00 #Blackest
 
+INVERT_TABLE = bytes(b ^ 0xFF for b in range(256))
+
+
+# 4-gray lookup tables. A gray value becomes a 2-bit level (0xC0 and 0x80 are moved down to 0x80 and 0x40 first),
+# and the level is shifted into its slot of the packed buffer byte, 4 pixels per byte.
+def gray_level(value):
+    if value == 0xC0:
+        value = 0x80
+    elif value == 0x80:
+        value = 0x40
+    return (value & 0xC0) >> 6
+
+GRAY_LEVEL_TABLE = [gray_level(value) for value in range(256)]
+GRAY_SHIFT_TABLES = [bytes((value << shift) & 0xFF for value in range(256)) for shift in (6, 4, 2, 0)]
+
+# For display_4Gray: a packed byte (4 levels) becomes 4 bits of the 0x10 (old) or 0x13 (new) plane, in the high or
+# low half of the plane byte. Levels 0 and 2 set the 0x10 bit, levels 0 and 1 set the 0x13 bit.
+def gray_plane_bits(packed, levels):
+    bits = 0
+    for shift in (6, 4, 2, 0):
+        bits = (bits << 1) | (((packed >> shift) & 0x03) in levels)
+    return bits
+
+GRAY_OLD_HIGH_TABLE = bytes(gray_plane_bits(packed, (0, 2)) << 4 for packed in range(256))
+GRAY_OLD_LOW_TABLE = bytes(gray_plane_bits(packed, (0, 2)) for packed in range(256))
+GRAY_NEW_HIGH_TABLE = bytes(gray_plane_bits(packed, (0, 1)) << 4 for packed in range(256))
+GRAY_NEW_LOW_TABLE = bytes(gray_plane_bits(packed, (0, 1)) for packed in range(256))
+
+
+def or_bytes(*parts):
+    # bitwise OR of equal-length byte strings, done on big integers rather than byte by byte
+    value = 0
+    for part in parts:
+        value |= int.from_bytes(part, 'big')
+    return value.to_bytes(len(parts[0]), 'big')
+
+# Register tables for the init routines, played through EPD.send_sequence. Each step is a command and its payload,
+# except POWER_ON, which powers the panel on and waits for the BUSY signal to be released.
+POWER_ON = None
+
+INIT_SEQUENCE = (
+    (0x06, (0x17, 0x17, 0x28, 0x17)),   # btst, if an exception is displayed, try using 0x38 for the third byte
+    (0x01, (0x07, 0x07, 0x28, 0x17)),   # POWER SETTING: VGH=20V, VGL=-20V, VDH=15V, VDL=-15V
+    POWER_ON,
+    (0x00, (0x1F,)),                    # PANNEL SETTING: KW-3f KWR-2F BWROTP 0f BWOTP 1f
+    (0x61, (0x03, 0x20, 0x01, 0xE0)),   # tres: source 800, gate 480
+    (0x15, (0x00,)),
+    # If the screen appears gray, use 0x50 with (0x10, 0x17) followed by 0x52 with (0x03,)
+    (0x50, (0x10, 0x07)),
+    (0x60, (0x22,)),                    # TCON SETTING
+)
+
+INIT_FAST_SEQUENCE = (
+    (0x00, (0x1F,)),                    # PANNEL SETTING: KW-3f KWR-2F BWROTP 0f BWOTP 1f
+    # If the screen appears gray, use 0x50 with (0x10, 0x17) followed by 0x52 with (0x03,)
+    (0x50, (0x10, 0x07)),
+    POWER_ON,
+    (0x06, (0x27, 0x27, 0x18, 0x17)),   # Booster Soft Start, enhanced display drive
+    (0xE0, (0x02,)),
+    (0xE5, (0x5A,)),
+)
+
+INIT_PART_SEQUENCE = (
+    (0x00, (0x1F,)),                    # PANNEL SETTING: KW-3f KWR-2F BWROTP 0f BWOTP 1f
+    POWER_ON,
+    (0xE0, (0x02,)),
+    (0xE5, (0x6E,)),
+)
+
+INIT_4GRAY_SEQUENCE = (
+    (0x00, (0x1F,)),                    # PANNEL SETTING: KW-3f KWR-2F BWROTP 0f BWOTP 1f
+    (0x50, (0x10, 0x07)),
+    POWER_ON,
+    (0x06, (0x27, 0x27, 0x18, 0x17)),   # Booster Soft Start, enhanced display drive
+    (0xE0, (0x02,)),
+    (0xE5, (0x5F,)),
+)
+
+BUSY_TIMEOUT = 30  # seconds before ReadBusy gives up on the panel
+BUSY_POLL_MIN = 0.001  # the polling interval in ReadBusy starts here and doubles up to BUSY_POLL_MAX
+BUSY_POLL_MAX = 0.05
+
 logger = logging.getLogger(__name__)
 
 class EPD:
@@ -54,6 +137,10 @@ class EPD:
         self.GRAY2  = GRAY2
         self.GRAY3  = GRAY3 #gray
         self.GRAY4  = GRAY4 #Blackest
+        self.busyTimeout = BUSY_TIMEOUT
+        self.busyTimes = []  # (command, seconds) for every busy wait, e.g. 0x12 for a refresh
+        self.spiSeconds = 0.0  # time spent in SPI writes, without the delays and busy waits around them
+        self.lastCommand = None
     
     # Hardware reset
     def reset(self):
@@ -65,80 +152,83 @@ class EPD:
         epdconfig.delay_ms(20)   
 
     def send_command(self, command):
+        if command != 0x71:
+            self.lastCommand = command  # remembered so busy waits can be attributed to the command that caused them
         epdconfig.digital_write(self.dc_pin, 0)
         epdconfig.digital_write(self.cs_pin, 0)
+        start = time.perf_counter()
         epdconfig.spi_writebyte([command])
+        self.spiSeconds += time.perf_counter() - start
         epdconfig.digital_write(self.cs_pin, 1)
 
     def send_data(self, data):
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
+        start = time.perf_counter()
         epdconfig.spi_writebyte([data])
+        self.spiSeconds += time.perf_counter() - start
         epdconfig.digital_write(self.cs_pin, 1)
 
     def send_data2(self, data):
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
+        start = time.perf_counter()
         epdconfig.SPI.writebytes2(data)
+        self.spiSeconds += time.perf_counter() - start
+        epdconfig.digital_write(self.cs_pin, 1)
+
+    def send_command_data(self, command, data=b''):
+        # Send a command followed by its whole payload, with a single DC toggle and one SPI transfer for the payload
+        self.lastCommand = command
+        epdconfig.digital_write(self.dc_pin, 0)
+        epdconfig.digital_write(self.cs_pin, 0)
+        start = time.perf_counter()
+        epdconfig.spi_writebyte([command])
+        if data:
+            epdconfig.digital_write(self.dc_pin, 1)
+            epdconfig.spi_writebyte2(bytes(data))
+        self.spiSeconds += time.perf_counter() - start
         epdconfig.digital_write(self.cs_pin, 1)
 
+    def send_sequence(self, sequence):
+        # Play a register table, see INIT_SEQUENCE
+        for step in sequence:
+            if step is POWER_ON:
+                self.send_command(0x04) #POWER ON
+                epdconfig.delay_ms(100)
+                self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
+            else:
+                self.send_command_data(*step)
+
     def ReadBusy(self):
+        # Wait for BUSY to go high. Uses an edge wait when the platform supports it, otherwise polls with a backoff
+        # so the CPU is not pegged during a multi-second refresh. Raises TimeoutError after busyTimeout seconds.
         logger.debug("e-Paper busy")
+        start = time.monotonic()
         self.send_command(0x71)
-        busy = epdconfig.digital_read(self.busy_pin)
-        while(busy == 0):
-            self.send_command(0x71)
-            busy = epdconfig.digital_read(self.busy_pin)
+        if hasattr(epdconfig, 'wait_busy_release'):
+            released = epdconfig.wait_busy_release(self.busyTimeout)
+        else:
+            interval = BUSY_POLL_MIN
+            released = epdconfig.digital_read(self.busy_pin) != 0
+            while not released and time.monotonic() - start < self.busyTimeout:
+                time.sleep(interval)
+                interval = min(interval * 2, BUSY_POLL_MAX)
+                self.send_command(0x71)
+                released = epdconfig.digital_read(self.busy_pin) != 0
+        elapsed = time.monotonic() - start
+        self.busyTimes.append((self.lastCommand, elapsed))
+        if not released:
+            raise TimeoutError("e-Paper still busy after {:.1f}s (command 0x{:02X})".format(elapsed, self.lastCommand))
         epdconfig.delay_ms(20)
-        logger.debug("e-Paper busy release")
+        logger.debug("e-Paper busy release after {:.3f}s".format(elapsed))
         
     def init(self):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
-        
-        self.send_command(0x06)     # btst
-        self.send_data(0x17)
-        self.send_data(0x17)
-        self.send_data(0x28)        # If an exception is displayed, try using 0x38
-        self.send_data(0x17)
-        
-        self.send_command(0x01)			#POWER SETTING
-        self.send_data(0x07)
-        self.send_data(0x07)    #VGH=20V,VGL=-20V
-        self.send_data(0x28)		#VDH=15V
-        self.send_data(0x17)		#VDL=-15V
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100)
-        self.ReadBusy()
-
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        self.send_command(0x61)        	#tres
-        self.send_data(0x03)		#source 800
-        self.send_data(0x20)
-        self.send_data(0x01)		#gate 480
-        self.send_data(0xE0)
-
-        self.send_command(0X15)
-        self.send_data(0x00)
-
-        # If the screen appears gray, use the annotated initialization command
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
-        # self.send_command(0X50)
-        # self.send_data(0x10)
-        # self.send_data(0x17)
-        # self.send_command(0X52)		
-        # self.send_data(0x03)
-
-        self.send_command(0X60)			#TCON SETTING
-        self.send_data(0x22)
-
+        self.send_sequence(INIT_SEQUENCE)
         # EPD hardware init end
         return 0
     
@@ -147,36 +237,7 @@ class EPD:
             return -1
         # EPD hardware init start
         self.reset()
-        
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        # If the screen appears gray, use the annotated initialization command
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
-        # self.send_command(0X50)
-        # self.send_data(0x10)
-        # self.send_data(0x17)
-        # self.send_command(0X52)		
-        # self.send_data(0x03)
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100) 
-        self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
-
-        #Enhanced display drive(Add 0x06 command)
-        self.send_command(0x06)			#Booster Soft Start 
-        self.send_data (0x27)
-        self.send_data (0x27)   
-        self.send_data (0x18)		
-        self.send_data (0x17)		
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5A)
-
+        self.send_sequence(INIT_FAST_SEQUENCE)
         # EPD hardware init end
         return 0
     
@@ -185,19 +246,7 @@ class EPD:
             return -1
         # EPD hardware init start
         self.reset()
-
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100) 
-        self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x6E)
-
+        self.send_sequence(INIT_PART_SEQUENCE)
         # EPD hardware init end
         return 0
     
@@ -207,30 +256,7 @@ class EPD:
             return -1
         # EPD hardware init start
         self.reset()
-
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-        
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100) 
-        self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
-
-        #Enhanced display drive(Add 0x06 command)
-        self.send_command(0x06)			#Booster Soft Start 
-        self.send_data (0x27)
-        self.send_data (0x27)   
-        self.send_data (0x18)		
-        self.send_data (0x17)	
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5F)
-
+        self.send_sequence(INIT_4GRAY_SEQUENCE)
         # EPD hardware init end
         return 0
 
@@ -247,61 +273,32 @@ class EPD:
             # return a blank buffer
             return [0x00] * (int(self.width/8) * self.height)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
-        # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        # in the e-paper world 0=white and 1=black. translate does this in C instead of a per-byte loop.
+        return bytearray(img.tobytes('raw').translate(INVERT_TABLE))
     
     def getbuffer_4Gray(self, image):
-        # logger.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 4) * self.height)
         image_monocolor = image.convert('L')
         imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        i=0
-        # logger.debug("imwidth = %d, imheight = %d",imwidth,imheight)
         if(imwidth == self.width and imheight == self.height):
             logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((x + (y * self.width))/4)] = ((pixels[x-3, y]&0xc0) | (pixels[x-2, y]&0xc0)>>2 | (pixels[x-1, y]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6)
-                        
         elif(imwidth == self.height and imheight == self.width):
             logger.debug("Horizontal")
-            for x in range(imwidth):
-                for y in range(imheight):
-                    newx = y
-                    newy = self.height - x - 1
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((newx + (newy * self.width))/4)] = ((pixels[x, y-3]&0xc0) | (pixels[x, y-2]&0xc0)>>2 | (pixels[x, y-1]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6) 
-        return buf
+            image_monocolor = image_monocolor.rotate(90, expand=True)
+        else:
+            return bytearray([0xFF] * (int(self.width / 4) * self.height))
+
+        # Quantise every pixel to its 2-bit gray level, then pack 4 pixels per byte with the first pixel in the top bits
+        levels = image_monocolor.point(GRAY_LEVEL_TABLE).tobytes()
+        return bytearray(or_bytes(*(levels[i::4].translate(table) for i, table in enumerate(GRAY_SHIFT_TABLES))))
 
     def display(self, image):
-        if(self.width % 8 == 0):
-            Width = self.width // 8
-        else:
-            Width = self.width // 8 +1
-        Height = self.height
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~image[i + j * Width]
+        # image is the packed frame from getbuffer, as bytes, a bytearray or anything else bytes-like
+        if not isinstance(image, (bytes, bytearray)):
+            image = bytes(image)
+        # The old-data plane is the inverted frame
         self.send_command(0x10)
-        self.send_data2(image1)
+        self.send_data2(image.translate(INVERT_TABLE))
 
         self.send_command(0x13)
         self.send_data2(image)
@@ -320,129 +317,70 @@ class EPD:
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-    def display_Partial(self, Image, Xstart, Ystart, Xend, Yend):
-        if((Xstart % 8 + Xend % 8 == 8 & Xstart % 8 > Xend % 8) | Xstart % 8 + Xend % 8 == 0 | (Xend - Xstart)%8 == 0):
-            Xstart = Xstart // 8 * 8
-            Xend = Xend // 8 * 8
-        else:
-            Xstart = Xstart // 8 * 8
-            if Xend % 8 == 0:
-                Xend = Xend // 8 * 8
-            else:
-                Xend = Xend // 8 * 8 + 1
-                
+    def crop_window(self, Image, Xstart, Ystart, Width, Height):
+        # Image is either the full packed frame from getbuffer, or already just the packed window
+        Image = bytes(Image)
+        rowBytes = (self.width + 7) // 8
+        if len(Image) == rowBytes * self.height and Width * Height != len(Image):
+            # crop the window out of the full frame, one row slice at a time
+            start = Xstart // 8
+            Image = b''.join(Image[y * rowBytes + start:y * rowBytes + start + Width]
+                             for y in range(Ystart, Ystart + Height))
+        return Image[:Width * Height]
+
+    def display_Partial(self, Image, Xstart, Ystart, Xend, Yend, OldImage=None):
+        # Image is either the full packed frame from getbuffer, or just the packed window. The window is widened to
+        # whole bytes, so Xstart is rounded down and Xend rounded up to a multiple of 8. OldImage is what the panel
+        # shows now, in the same form; the controller's old-data RAM is lost when the panel is powered off, so pass
+        # it whenever the panel has been powered down since that frame was shown.
+        Xstart = Xstart // 8 * 8
+        Xend = (Xend + 7) // 8 * 8
         Width = (Xend - Xstart) // 8
         Height = Yend - Ystart
 	
-        self.send_command(0x50)
-        self.send_data(0xA9)
-        self.send_data(0x07)
+        self.send_command_data(0x50, (0xA9, 0x07))
 
         self.send_command(0x91)		#This command makes the display enter partial mode
-        self.send_command(0x90)		#resolution setting
-        self.send_data (Xstart//256)
-        self.send_data (Xstart%256)   #x-start    
-
-        self.send_data ((Xend-1)//256)		
-        self.send_data ((Xend-1)%256)  #x-end	
-
-        self.send_data (Ystart//256)  #
-        self.send_data (Ystart%256)   #y-start    
+        self.send_command_data(0x90, (		#resolution setting
+            Xstart//256, Xstart%256,            #x-start
+            (Xend-1)//256, (Xend-1)%256,        #x-end
+            Ystart//256, Ystart%256,            #y-start
+            (Yend-1)//256, (Yend-1)%256,        #y-end
+            0x01))
 
-        self.send_data ((Yend-1)//256)		
-        self.send_data ((Yend-1)%256)  #y-end
-        self.send_data (0x01)
+        if OldImage is not None:
+            self.send_command(0x10)   #Write the frame on screen to the old-data RAM, the waveform compares against it
+            self.send_data2(self.crop_window(OldImage, Xstart, Ystart, Width, Height).translate(INVERT_TABLE))
 
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~Image[i + j * Width]
-
-        self.send_command(0x13)   #Write Black and White image to RAM
-        self.send_data2(image1)
+        self.send_command(0x13)   #Write Black and White image to RAM, only the window
+        self.send_data2(self.crop_window(Image, Xstart, Ystart, Width, Height).translate(INVERT_TABLE))
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
     def display_4Gray(self, image):
+        # Each byte of the two planes covers 8 pixels, i.e. two bytes of the packed 4-gray buffer
+        image = bytes(image)
         self.send_command(0x10)
-        for i in range(0, 48000):     
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x01  
-                    elif(temp2 == 0x80): 
-                        temp3 |= 0x01 
-                    else: #0x40
-                        temp3 |= 0x00 
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0): 
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00): 
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x01
-                    else :   #0x40
-                        temp3 |= 0x00	
-                    if(j!=1 or k!=1):				
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
-            
-        self.send_command(0x13)	       
-        for i in range(0, 48000):       
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00
-                    else: #0x40
-                        temp3 |= 0x01 
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0): 
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00): 
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00 
-                    else:    #0x40
-                            temp3 |= 0x01	
-                    if(j!=1 or k!=1):					
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
-        
+        self.send_data2(or_bytes(image[0::2].translate(GRAY_OLD_HIGH_TABLE),
+                                 image[1::2].translate(GRAY_OLD_LOW_TABLE)))
+
+        self.send_command(0x13)
+        self.send_data2(or_bytes(image[0::2].translate(GRAY_NEW_HIGH_TABLE),
+                                 image[1::2].translate(GRAY_NEW_LOW_TABLE)))
+
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
     def sleep(self):
-        self.send_command(0x50)
-        self.send_data(0XF7)
+        self.send_command_data(0x50, (0XF7,))
         
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
         
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_command_data(0x07, (0XA5,)) # DEEP_SLEEP
         
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
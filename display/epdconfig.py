@@ -30,8 +30,8 @@
 import os
 import logging
 import sys
+import threading
 import time
-import subprocess
 
 from ctypes import *
 
@@ -95,6 +95,10 @@ class RaspberryPi:
         elif pin == self.PWR_PIN:
             return self.PWR_PIN.value
 
+    def wait_busy_release(self, timeout):
+        # BUSY is high when the panel is idle, wait for the rising edge instead of polling
+        return self.GPIO_BUSY_PIN.wait_for_press(timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -301,22 +305,86 @@ class SunriseX3:
         self.GPIO.cleanup([self.RST_PIN, self.DC_PIN, self.CS_PIN, self.BUSY_PIN], self.PWR_PIN)
 
 
-if sys.version_info[0] == 2:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
-else:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE, text=True)
-output, _ = process.communicate()
-if sys.version_info[0] == 2:
-    output = output.decode(sys.stdout.encoding)
-
-if "Raspberry" in output:
-    implementation = RaspberryPi()
-elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
-    implementation = SunriseX3()
-else:
-    implementation = JetsonNano()
-
-for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+# Pin definition, shared by every platform. They are module constants so that creating an EPD does not need the
+# platform to be known yet.
+RST_PIN  = 17
+DC_PIN   = 25
+CS_PIN   = 8
+BUSY_PIN = 24
+PWR_PIN  = 18
+
+
+def create_simulator():
+    from .simulator import Simulator
+    return Simulator()
+
+
+BACKENDS = {
+    'raspberrypi': RaspberryPi,
+    'sunrisex3': SunriseX3,
+    'jetsonnano': JetsonNano,
+    'simulator': create_simulator,
+}
+
+_backend = None  # set by set_backend, otherwise taken from EPD_BACKEND or detected
+_implementation = None
+_lock = threading.Lock()
+
+
+def detect_platform():
+    # Read the board model directly instead of running a shell; device-tree/model is absent on some kernels
+    for path in ('/proc/device-tree/model', '/proc/cpuinfo'):
+        try:
+            with open(path, 'rb') as modelFile:
+                if b'Raspberry' in modelFile.read():
+                    return 'raspberrypi'
+        except OSError:
+            continue
+    if os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
+        return 'sunrisex3'
+    return 'jetsonnano'
+
+
+def set_backend(name):
+    """
+    Pick the platform explicitly, e.g. from the "epdBackend" setting in config.json. A falsy name keeps the default,
+    which is EPD_BACKEND from the environment or else the detected platform. Must be called before the first
+    hardware access.
+    """
+    global _backend
+    if name and name not in BACKENDS:
+        raise ValueError('Unknown EPD backend {!r}, expected one of {}'.format(name, ', '.join(BACKENDS)))
+    if _implementation is not None and name and name != _backend:
+        raise RuntimeError('EPD backend {} is already in use'.format(_backend))
+    _backend = name or None
+
+
+def get_implementation():
+    """
+    Return the platform implementation, creating it on first use. This is when spidev, gpiozero and the GPIO pins
+    are claimed, so importing the driver or creating an EPD never touches the hardware.
+    """
+    global _backend, _implementation
+    with _lock:
+        if _implementation is None:
+            # the choice is only kept once the platform is created, so a failed one can still be replaced
+            backend = _backend or os.environ.get('EPD_BACKEND') or detect_platform()
+            logger.debug("Using the {} EPD backend".format(backend))
+            _implementation = BACKENDS[backend]()
+            _backend = backend
+            # bind the implementation's functions to this module, so later calls skip __getattr__
+            for func in [x for x in dir(_implementation) if not x.startswith('_')]:
+                setattr(sys.modules[__name__], func, getattr(_implementation, func))
+    return _implementation
+
+
+def __getattr__(name):
+    # digital_write, spi_writebyte2, module_init and the rest are looked up here until the platform is created
+    if name.startswith('_'):
+        raise AttributeError(name)
+    try:
+        return getattr(get_implementation(), name)
+    except AttributeError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name)) from None
 
 ### END OF FILE ###
\ No newline at end of file
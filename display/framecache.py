@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This remembers the last frame sent to the eink display, so that a refresh can be skipped entirely when the newly
+rendered frame is byte-identical to what is already on the screen, or limited to the rectangles that changed.
+The packed frame is kept in last_frame.bin, and its hash and the number of partial refreshes since the last full
+refresh in last_frame.json.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from atomicfile import write_atomic
+
+MAX_DIRTY_RECTS = 4  # beyond this many separate bands, one bounding rectangle is refreshed instead
+BAND_GAP_ROWS = 8  # changed rows closer together than this are refreshed as one band
+MAX_DIRTY_FRACTION = 0.5  # when more than this much of the screen changed, a full refresh is cheaper
+
+
+class FrameCache:
+
+    def __init__(self, path):
+        # path is the common prefix of the two files, e.g. display/last_frame
+        self.logger = logging.getLogger('maginkcal')
+        self.framePath = path + '.bin'
+        self.statePath = path + '.json'
+        self.lastHash = None
+        self.partialCount = 0
+        self.lastFrame = None
+        if os.path.exists(self.statePath):
+            try:
+                with open(self.statePath, 'r') as stateFile:
+                    state = json.load(stateFile)
+                self.lastHash = state.get('hash')
+                self.partialCount = state.get('partialCount', 0)
+            except ValueError:
+                self.logger.info('Frame state at {} is unreadable, starting from scratch'.format(self.statePath))
+
+    def get_hash(self, buffer):
+        return hashlib.sha256(bytes(buffer)).hexdigest()
+
+    def is_unchanged(self, buffer):
+        return self.lastHash is not None and self.get_hash(buffer) == self.lastHash
+
+    def load_frame(self):
+        if self.lastFrame is None and self.lastHash is not None and os.path.exists(self.framePath):
+            with open(self.framePath, 'rb') as frameFile:
+                frame = frameFile.read()
+            if self.get_hash(frame) == self.lastHash:
+                self.lastFrame = frame
+        return self.lastFrame
+
+    def get_dirty_rects(self, buffer, width, height):
+        """
+        Compare the new packed frame with the last one shown, and return the changed areas as a list of
+        (Xstart, Ystart, Xend, Yend) pixel rectangles aligned to whole bytes. Returns None when there is no usable
+        previous frame or so much has changed that a full refresh is the better choice.
+        """
+        lastFrame = self.load_frame()
+        buffer = bytes(buffer)
+        rowBytes = (width + 7) // 8
+        if lastFrame is None or len(lastFrame) != len(buffer) or len(buffer) != rowBytes * height:
+            return None
+
+        # For each changed row, XOR the old and new row as big integers to find the first and last changed byte
+        bands = []
+        for y in range(height):
+            diff = (int.from_bytes(lastFrame[y * rowBytes:(y + 1) * rowBytes], 'big') ^
+                    int.from_bytes(buffer[y * rowBytes:(y + 1) * rowBytes], 'big'))
+            if not diff:
+                continue
+            first = rowBytes - (diff.bit_length() + 7) // 8
+            last = rowBytes - 1 - ((diff & -diff).bit_length() - 1) // 8
+            if bands and y - bands[-1][3] <= BAND_GAP_ROWS:
+                band = bands[-1]
+                bands[-1] = [min(band[0], first), band[1], max(band[2], last), y]
+            else:
+                bands.append([first, y, last, y])
+
+        if len(bands) > MAX_DIRTY_RECTS:
+            bands = [[min(b[0] for b in bands), bands[0][1], max(b[2] for b in bands), bands[-1][3]]]
+
+        rects = [(first * 8, top, (last + 1) * 8, bottom + 1) for first, top, last, bottom in bands]
+        dirtyArea = sum((xEnd - xStart) * (yEnd - yStart) for xStart, yStart, xEnd, yEnd in rects)
+        if dirtyArea > MAX_DIRTY_FRACTION * width * height:
+            return None
+        return rects
+
+    def save(self, buffer, partial=False):
+        # only call this once the frame is actually on the screen
+        frame = bytes(buffer)
+        self.lastFrame = frame
+        self.lastHash = self.get_hash(frame)
+        self.partialCount = self.partialCount + 1 if partial else 0
+        write_atomic(self.framePath, frame)
+        write_atomic(self.statePath, json.dumps({'hash': self.lastHash, 'partialCount': self.partialCount}))
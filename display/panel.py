@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This takes the eink display through one calendar refresh. It initialises the panel for a full or a partial refresh,
+clears or calibrates it when the refresh policy asks, skips frames that are already on screen and puts the panel to
+sleep at the end. The frame cache and the refresh policy carry what it needs to know from one boot to the next.
+
+prepare may run in a background thread while the calendar is still being fetched (isEarlyPanelInit). It does not
+change the helper's state, it returns the panel mode and whether the screen was cleared, and show applies that
+result once it has joined the thread. So panelMode and isScreenCleared are only ever changed by the thread that
+calls show and sleep.
+"""
+
+import logging
+from metrics.tracer import get_tracer
+
+
+class PanelHelper:
+
+    def __init__(self, epd, frameCache, refreshPolicy, partialRefreshLimit=0):
+        self.logger = logging.getLogger('maginkcal')
+        self.tracer = get_tracer()
+        self.epd = epd
+        self.frameCache = frameCache
+        self.refreshPolicy = refreshPolicy
+        self.partialRefreshLimit = partialRefreshLimit
+        self.panelMode = None  # 'full' or 'partial' once the panel has been initialised for that kind of refresh
+        self.isScreenCleared = False  # True from a clear or calibration until the next frame is shown
+        self.refreshed = None  # the kind of refresh the panel actually did, for the run history
+        self.prepareFuture = None  # the Future of prepare, when it was started in the background
+
+    def run_stage(self, name, func, *args):
+        # Time a call into the EPD driver, noting how much of it was spent waiting for the BUSY line and in SPI
+        # transfers; the rest is mostly the fixed delays of the driver
+        busyCount = len(self.epd.busyTimes)
+        spiStart = self.epd.spiSeconds
+        with self.tracer.stage(name) as record:
+            result = func(*args)
+            record['busyWait'] = round(sum(seconds for _, seconds in self.epd.busyTimes[busyCount:]), 4)
+            record['spi'] = round(self.epd.spiSeconds - spiStart, 4)
+        return result
+
+    def prepare(self, today):
+        """
+        Initialise the panel for a full refresh, clearing or calibrating it first only when the policy asks.
+        Returns the new panel mode and whether the screen was cleared, leaving the helper's state to the caller.
+        """
+        self.run_stage('epd_init', self.epd.init)
+        self.logger.info("E-paper display initialized successfully.")
+        action = self.refreshPolicy.get_action(today, self.frameCache.partialCount)
+        if action == 'calibrate':
+            from display.display import DisplayHelper
+            self.run_stage('calibrate', DisplayHelper(self.epd.width, self.epd.height, self.epd).calibrate,
+                           self.refreshPolicy.calibrateCycles)
+        elif action == 'clear':
+            self.run_stage('clear', self.epd.Clear)
+        if action:
+            self.refreshPolicy.save(today)
+            self.logger.info("E-paper display {} done ({} policy)".format(action, self.refreshPolicy.policy))
+        return 'full', action is not None
+
+    def show(self, buffer, today):
+        """
+        Show the packed frame: skip it when it is already on screen, refresh only the changed rectangles while
+        partial refreshes are allowed, and do a full refresh otherwise.
+        """
+        if self.prepareFuture is not None and self.panelMode is None:
+            # join the early panel power-up before touching the panel
+            self.panelMode, self.isScreenCleared = self.prepareFuture.result()
+        frameCache = self.frameCache
+        if frameCache.is_unchanged(buffer) and not self.isScreenCleared:
+            self.logger.info("Frame is identical to the one on screen, skipping the display refresh.")
+            return
+        dirtyRects = None
+        if frameCache.partialCount < self.partialRefreshLimit and not self.isScreenCleared:
+            dirtyRects = frameCache.get_dirty_rects(buffer, self.epd.width, self.epd.height)
+        if dirtyRects:
+            if self.panelMode != 'partial':
+                self.run_stage('epd_init_part', self.epd.init_part)
+                self.panelMode = 'partial'
+            # the panel was powered off since the last frame was shown, which clears its old-data RAM, so the last
+            # frame is sent again for the partial waveform to compare against
+            for rect in dirtyRects:
+                self.run_stage('display_partial', self.epd.display_Partial, buffer, *rect, frameCache.lastFrame)
+            frameCache.save(buffer, partial=True)
+            self.refreshed = self.refreshed or 'partial'
+            self.logger.info("Partially refreshed {} ({} of {} partial refreshes before a full one)".format(
+                dirtyRects, frameCache.partialCount, self.partialRefreshLimit))
+        else:
+            if self.panelMode != 'full':
+                self.panelMode, self.isScreenCleared = self.prepare(today)
+            self.run_stage('display', self.epd.display, buffer)
+            frameCache.save(buffer)
+            self.isScreenCleared = False  # a frame is on screen again
+            self.refreshed = 'full'
+
+    def sleep(self):
+        # Put the panel to sleep if it was powered up, and record the totals of its busy waits and SPI transfers
+        if not self.panelMode:
+            return
+        self.run_stage('sleep', self.epd.sleep)
+        self.logger.info("E-paper display put to sleep.")
+        self.logger.info("E-paper busy waits: " + ", ".join(
+            "0x{:02X} {:.2f}s".format(command, seconds) for command, seconds in self.epd.busyTimes))
+        self.tracer.add('busy_wait', sum(seconds for _, seconds in self.epd.busyTimes))
+        self.tracer.add('spi_transfer', self.epd.spiSeconds)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This decides whether a full refresh of the eink display should start with a clear (or a calibration, when
+calibrateCycles is set), instead of clearing the screen before every refresh. The date of the last clear is kept in
+refresh_state.json so that the weekly policy survives the Pi being powered off between refreshes.
+
+The policies are:
+    always   - clear before every full refresh, as the calendar did originally
+    weekly   - clear on the first full refresh of each calendar week
+    never    - never clear, the new frame simply replaces the old one
+    partials - clear only when at least clearAfterPartials partial refreshes were shown since the last full one
+"""
+
+import datetime as dt
+import json
+import logging
+import os
+from atomicfile import write_atomic
+
+POLICIES = ('always', 'weekly', 'never', 'partials')
+
+
+class RefreshPolicy:
+
+    def __init__(self, path, policy='weekly', weekStartDay=6, clearAfterPartials=1, calibrateCycles=0):
+        self.logger = logging.getLogger('maginkcal')
+        if policy not in POLICIES:
+            raise ValueError('Unknown clear policy {!r}, expected one of {}'.format(policy, ', '.join(POLICIES)))
+        self.path = path
+        self.policy = policy
+        self.weekStartDay = weekStartDay
+        self.clearAfterPartials = clearAfterPartials
+        self.calibrateCycles = calibrateCycles
+        self.lastClearDate = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as stateFile:
+                    state = json.load(stateFile)
+                if state.get('lastClearDate'):
+                    self.lastClearDate = dt.date.fromisoformat(state['lastClearDate'])
+            except ValueError:
+                self.logger.info('Refresh state at {} is unreadable, starting from scratch'.format(self.path))
+
+    def get_action(self, today, partialCount):
+        # returns 'clear', 'calibrate' or None for a full refresh happening today
+        if self.policy == 'always':
+            isNeeded = True
+        elif self.policy == 'weekly':
+            weekStart = today - dt.timedelta(days=((today.weekday() + (7 - self.weekStartDay)) % 7))
+            isNeeded = self.lastClearDate is None or self.lastClearDate < weekStart
+        elif self.policy == 'partials':
+            isNeeded = partialCount >= self.clearAfterPartials
+        else:
+            isNeeded = False
+        if not isNeeded:
+            return None
+        return 'calibrate' if self.calibrateCycles > 0 else 'clear'
+
+    def save(self, today):
+        # only call this once the clear or calibration has actually been done
+        self.lastClearDate = today
+        write_atomic(self.path, json.dumps({'lastClearDate': today.isoformat()}))
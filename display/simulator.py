@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is a hardware-free stand-in for the Raspberry Pi implementation in epdconfig.py, so that the EPD driver can be
+run and benchmarked on any Linux box. Select it with "epdBackend": "simulator" in config.json, or by setting the
+environment variable EPD_BACKEND=simulator.
+
+It records every command and its data bytes, keeps the panel's old (0x10) and new (0x13) RAM, and on each refresh
+(0x12) rebuilds what the panel would show, which get_image returns. BUSY durations are modelled per command instead
+of measured: a refresh takes as long as the refresh mode selected by the init routine, and power on (0x04) and
+power off (0x02) take a short fixed time. SPI transfers are modelled at the 4 MHz clock set in module_init.
+
+By default nothing sleeps, so the driver runs at the speed of its host-side code, and the modelled panel time is
+reported by get_stats. With realtime=True, BUSY is held low and delays sleep for the modelled time, as on the Pi.
+"""
+
+import logging
+import time
+from PIL import Image, ImageChops
+
+WIDTH = 800
+HEIGHT = 480
+ROW_BYTES = WIDTH // 8
+SPI_SPEED_HZ = 4000000
+
+# Approximate refresh times of the 7.5inch V2 panel, in seconds, for each refresh mode. The mode is picked by the
+# 0xE5 value written by init_fast, init_part and init_4Gray, and any refresh inside a partial window is partial.
+REFRESH_SECONDS = {'full': 5.0, 'fast': 1.5, 'partial': 0.4, '4gray': 3.0}
+MODE_BY_E5 = {0x5A: 'fast', 0x6E: 'partial', 0x5F: '4gray'}
+BUSY_SECONDS = {0x04: 0.08, 0x02: 0.03}  # power on and power off
+
+INVERT_TABLE = bytes(b ^ 0xFF for b in range(256))
+# (old bit + 2 * new bit) to the gray shown in 4-gray mode, matching the planes written by EPD.display_4Gray
+GRAY_TABLE = [0xFF, 0xC0, 0x80, 0x00] + [0] * 252
+
+
+class Simulator:
+    # Pin definition, the same as RaspberryPi so the driver does not notice the difference
+    RST_PIN  = 17
+    DC_PIN   = 25
+    CS_PIN   = 8
+    BUSY_PIN = 24
+    PWR_PIN  = 18
+
+    def __init__(self, realtime=False):
+        self.logger = logging.getLogger('maginkcal')
+        self.realtime = realtime
+        self.SPI = self  # EPD.send_data2 writes through epdconfig.SPI.writebytes2
+        self.commands = []  # [command, bytearray of data] for every command sent
+        self.oldRam = bytearray(ROW_BYTES * HEIGHT)
+        self.newRam = bytearray(ROW_BYTES * HEIGHT)
+        self.screen = Image.new('L', (WIDTH, HEIGHT), 0xFF)
+        self.dc = 0
+        self.busyUntil = 0
+        self.stats = {'commands': 0, 'dataBytes': 0, 'spiSeconds': 0.0, 'busySeconds': 0.0, 'delaySeconds': 0.0,
+                      'refreshes': {}}
+        self.reset_registers()
+
+    def reset_registers(self):
+        self.refreshMode = 'full'
+        self.dataPolarity = 0  # DDX[0] of 0x50, when set the new RAM bits are inverted before they are shown
+        self.window = None  # (Xstart, Ystart, Xend, Yend) set by 0x90
+        self.isPartial = False
+
+    def digital_write(self, pin, value):
+        if pin == self.DC_PIN:
+            self.dc = value
+        elif pin == self.RST_PIN and not value:
+            self.reset_registers()
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            return 0 if self.realtime and time.monotonic() < self.busyUntil else 1
+        return 0
+
+    def wait_busy_release(self, timeout):
+        if self.realtime:
+            remaining = self.busyUntil - time.monotonic()
+            if remaining > timeout:
+                time.sleep(timeout)
+                return False
+            time.sleep(max(remaining, 0))
+        return True
+
+    def delay_ms(self, delaytime):
+        self.stats['delaySeconds'] += delaytime / 1000.0
+        if self.realtime:
+            time.sleep(delaytime / 1000.0)
+
+    def spi_writebyte(self, data):
+        self.write(data)
+
+    def spi_writebyte2(self, data):
+        self.write(data)
+
+    def writebytes2(self, data):
+        self.write(data)
+
+    def write(self, data):
+        data = bytes(data)
+        self.stats['dataBytes'] += len(data)
+        self.stats['spiSeconds'] += len(data) * 8 / SPI_SPEED_HZ
+        if self.dc:
+            if self.commands:
+                self.commands[-1][1] += data
+            return
+        for command in data:
+            self.finish_command()
+            self.commands.append([command, bytearray()])
+            self.stats['commands'] += 1
+            if command == 0x12:
+                self.refresh()
+            elif command in BUSY_SECONDS:
+                self.set_busy(BUSY_SECONDS[command])
+            elif command == 0x91:
+                self.isPartial = True
+            elif command == 0x92:
+                self.isPartial = False
+
+    def finish_command(self):
+        # apply the data of the previous command, now that all of it has been sent
+        if not self.commands:
+            return
+        command, data = self.commands[-1]
+        if command in (0x10, 0x13):
+            self.write_ram(self.oldRam if command == 0x10 else self.newRam, data)
+        elif command == 0x50 and data:
+            self.dataPolarity = data[0] & 0x01
+        elif command == 0xE5 and data:
+            self.refreshMode = MODE_BY_E5.get(data[0], 'full')
+        elif command == 0x90 and len(data) >= 8:
+            self.window = ((data[0] << 8 | data[1]), (data[4] << 8 | data[5]),
+                           (data[2] << 8 | data[3]) + 1, (data[6] << 8 | data[7]) + 1)
+
+    def get_region(self):
+        # the area the next RAM write or refresh applies to, in whole bytes across and rows down
+        if self.isPartial and self.window:
+            xStart, yStart, xEnd, yEnd = self.window
+            return xStart // 8, yStart, (xEnd + 7) // 8, yEnd
+        return 0, 0, ROW_BYTES, HEIGHT
+
+    def write_ram(self, ram, data):
+        first, top, last, bottom = self.get_region()
+        width = last - first
+        if width == ROW_BYTES:
+            ram[top * ROW_BYTES:top * ROW_BYTES + len(data)] = data[:(bottom - top) * ROW_BYTES]
+            return
+        for y in range(top, min(bottom, top + len(data) // width)):
+            row = (y - top) * width
+            ram[y * ROW_BYTES + first:y * ROW_BYTES + last] = data[row:row + width]
+
+    def set_busy(self, seconds):
+        self.stats['busySeconds'] += seconds
+        self.busyUntil = time.monotonic() + seconds
+
+    def refresh(self):
+        mode = 'partial' if self.isPartial else self.refreshMode
+        self.stats['refreshes'][mode] = self.stats['refreshes'].get(mode, 0) + 1
+        self.set_busy(REFRESH_SECONDS[mode])
+
+        # new RAM bits are black when set, unless the polarity is inverted; PIL's 1-bit images use 1 for white
+        newRam = bytes(self.newRam) if self.dataPolarity else bytes(self.newRam).translate(INVERT_TABLE)
+        image = Image.frombytes('1', (WIDTH, HEIGHT), newRam).convert('L')
+        if mode == '4gray':
+            # in 4-gray mode each pixel is set by a bit from each plane, old + 2 * new picks one of the 4 grays
+            old = Image.frombytes('1', (WIDTH, HEIGHT), bytes(self.oldRam)).convert('L').point(lambda v: v and 1)
+            new = Image.frombytes('1', (WIDTH, HEIGHT), bytes(self.newRam)).convert('L').point(lambda v: v and 2)
+            image = ImageChops.add(old, new).point(GRAY_TABLE)
+        first, top, last, bottom = self.get_region()
+        box = (first * 8, top, last * 8, bottom)
+        self.screen.paste(image.crop(box), box)
+
+    def get_image(self):
+        # what the panel shows after the last refresh, in 'L' mode
+        return self.screen.copy()
+
+    def get_stats(self):
+        stats = dict(self.stats, refreshes=dict(self.stats['refreshes']))
+        stats['panelSeconds'] = stats['spiSeconds'] + stats['busySeconds'] + stats['delaySeconds']
+        return stats
+
+    def module_init(self, cleanup=False):
+        return 0
+
+    def module_exit(self, cleanup=False):
+        self.finish_command()
+        self.logger.debug("Simulated panel powered down")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This keeps the OAuth credentials for the Google Calendar in token.json, next to credentials.json. The token is
+written atomically and is only readable by its owner. The access token is refreshed ahead of its expiry, so that
+fetching can start with the stored token instead of waiting on the token endpoint, and a token.pickle left by
+earlier versions is converted to token.json the first time it is loaded.
+"""
+
+import datetime as dt
+import logging
+import os
+import pickle
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from atomicfile import write_atomic
+
+SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+REFRESH_MARGIN = dt.timedelta(minutes=5)  # access tokens expiring sooner than this are refreshed before use
+
+
+class CredentialStore:
+
+    def __init__(self, folder, scopes=SCOPES):
+        self.logger = logging.getLogger('maginkcal')
+        self.scopes = scopes
+        self.tokenPath = os.path.join(folder, 'token.json')
+        self.legacyPath = os.path.join(folder, 'token.pickle')
+        self.secretsPath = os.path.join(folder, 'credentials.json')
+
+    def load(self):
+        # the stored credentials, or None if there are none yet; this never goes to the network
+        if os.path.exists(self.tokenPath):
+            return Credentials.from_authorized_user_file(self.tokenPath, self.scopes)
+        if os.path.exists(self.legacyPath):
+            with open(self.legacyPath, 'rb') as token:
+                creds = pickle.load(token)
+            self.save(creds)
+            self.logger.info('Converted {} to {}'.format(self.legacyPath, self.tokenPath))
+            return creds
+        return None
+
+    def save(self, creds):
+        # the token grants access to the calendar, so only its owner may read it
+        write_atomic(self.tokenPath, creds.to_json(), 0o600)
+
+    def is_expiring(self, creds, margin=REFRESH_MARGIN):
+        # google-auth keeps the expiry as a naive UTC datetime
+        now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+        return creds.expiry is None or creds.expiry - margin <= now
+
+    def refresh(self, creds, margin=REFRESH_MARGIN):
+        # refresh the access token if it expires within margin, and store the new one
+        if creds.refresh_token and self.is_expiring(creds, margin):
+            creds.refresh(Request())
+            self.save(creds)
+            self.logger.info('OAuth access token refreshed, valid until {} UTC'.format(creds.expiry))
+        return creds
+
+    def authorize(self):
+        # first-time login in the browser, using the OAuth client in credentials.json
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file(self.secretsPath, self.scopes)
+        creds = flow.run_local_server(port=0)
+        self.save(creds)
+        return creds
+
+    def get_credentials(self, margin=REFRESH_MARGIN):
+        """
+        Return usable credentials: the stored ones while the access token is fresh, refreshed ones when it is about
+        to expire, or new ones from the browser login when there is nothing to refresh.
+        """
+        creds = self.load()
+        if creds is None or (not creds.refresh_token and not creds.valid):
+            return self.authorize()
+        return self.refresh(creds, margin)
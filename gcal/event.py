@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is the compact record for a calendar event, as produced by GcalHelper and read by the renderers. It uses
+__slots__ so that large calendars take less memory and attribute access in the render loop stays cheap.
+The dict form used previously is still available through to_dict and from_dict.
+"""
+
+
+class Event:
+    __slots__ = ('summary', 'allday', 'startDatetime', 'endDatetime', 'updatedDatetime', 'isUpdated', 'isMultiday')
+    # the fields that change what is drawn; updatedDatetime and isUpdated are not shown on the calendar
+    RENDERED_FIELDS = ('summary', 'allday', 'startDatetime', 'endDatetime', 'isMultiday')
+
+    def __init__(self, summary, allday, startDatetime, endDatetime, updatedDatetime, isUpdated, isMultiday):
+        self.summary = summary
+        self.allday = allday
+        self.startDatetime = startDatetime
+        self.endDatetime = endDatetime
+        self.updatedDatetime = updatedDatetime
+        self.isUpdated = isUpdated
+        self.isMultiday = isMultiday
+
+    def __repr__(self):
+        return 'Event({!r}, {})'.format(self.summary, self.startDatetime.isoformat())
+
+    def __eq__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def render_key(self):
+        # events with equal render keys look the same on the calendar
+        return tuple(getattr(self, name) for name in self.RENDERED_FIELDS)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, eventDict):
+        return cls(*(eventDict[name] for name in cls.__slots__))
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This keeps the last successfully fetched set of events on disk, so the calendar can be drawn straight away on the
+next boot while fresh events are still being fetched, or when the network is slow or down.
+"""
+
+import logging
+import os
+import pickle
+from atomicfile import write_atomic
+
+
+class EventCache:
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('maginkcal')
+        self.path = path
+
+    def load(self, startDatetime, endDatetime):
+        # returns the cached events that fall within the window, or None if there is no usable cache
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as cacheFile:
+                events = pickle.load(cacheFile)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            self.logger.info('Event cache at {} is unreadable: {}'.format(self.path, e))
+            return None
+        return [event for event in events if event.endDatetime >= startDatetime and event.startDatetime <= endDatetime]
+
+    def save(self, events):
+        write_atomic(self.path, pickle.dumps(events))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is a small on-disk store for incremental calendar syncing. For each calendar it keeps the nextSyncToken from
+the last sync, the time window of the last full sync, and a compact copy of every event (summary, start, end and
+updated), keyed by event ID. It is saved as JSON next to token.json, and events that ended before the calendar
+window are dropped whenever it is saved.
+"""
+
+import datetime as dt
+import json
+import logging
+import os
+from atomicfile import write_atomic
+
+
+class EventStore:
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('maginkcal')
+        self.path = path
+        self.calendars = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as storeFile:
+                    self.calendars = json.load(storeFile)
+            except ValueError:
+                self.logger.info('Event store at {} is unreadable, starting from scratch'.format(path))
+
+    def get(self, calendarId):
+        # returns the stored state for the calendar, or None if it has never been synced
+        return self.calendars.get(calendarId)
+
+    def reset(self, calendarId, timeMin, timeMax):
+        self.calendars[calendarId] = {'syncToken': None, 'timeMin': timeMin, 'timeMax': timeMax, 'events': {}}
+        return self.calendars[calendarId]
+
+    def apply(self, calendarId, items, syncToken):
+        # apply a page of events from the API: cancelled events are removed, the rest are added or replaced
+        calendar = self.calendars[calendarId]
+        for item in items:
+            if item.get('status') == 'cancelled':
+                calendar['events'].pop(item['id'], None)
+            else:
+                calendar['events'][item['id']] = {
+                    'summary': item.get('summary', ''),
+                    'start': item['start'],
+                    'end': item['end'],
+                    'updated': item['updated'],
+                }
+        if syncToken:
+            calendar['syncToken'] = syncToken
+
+    def events(self, calendarId):
+        return list(self.calendars[calendarId]['events'].values())
+
+    def is_ended(self, event, startDatetime):
+        # all-day events end on the (exclusive) date, the others at a timestamp with its UTC offset
+        end = event['end']
+        if end.get('dateTime') is None:
+            return dt.date.fromisoformat(end['date']) <= startDatetime.date()
+        return dt.datetime.fromisoformat(end['dateTime'].replace('Z', '+00:00')) < startDatetime
+
+    def prune(self, startDatetime):
+        # drop the events that ended before startDatetime, they can never be shown again
+        pruned = 0
+        for calendar in self.calendars.values():
+            ended = [eventId for eventId, event in calendar['events'].items() if self.is_ended(event, startDatetime)]
+            for eventId in ended:
+                del calendar['events'][eventId]
+            pruned += len(ended)
+        if pruned:
+            self.logger.info('Dropped {} past events from the event store'.format(pruned))
+
+    def save(self, startDatetime=None):
+        if startDatetime is not None:
+            self.prune(startDatetime)
+        write_atomic(self.path, json.dumps(self.calendars, separators=(',', ':')))
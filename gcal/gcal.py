@@ -2,48 +2,108 @@
 # -*- coding: utf-8 -*-
 """
 This is where we retrieve events from the Google Calendar. Before doing so, make sure you have both the
-credentials.json and token.pickle in the same folder as this file. If not, run quickstart.py first.
+credentials.json and token.json in the same folder as this file. If not, run quickstart.py first.
 """
 
 from __future__ import print_function
 import datetime as dt
-import pickle
 import os.path
 import pathlib
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import queue
+import threading
+import time
+import google_auth_httplib2
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.http import build_http
+from googleapiclient.errors import HttpError
 import logging
+from gcal.event import Event
+from gcal.eventstore import EventStore
+from gcal.credentialstore import CredentialStore
+from metrics.tracer import get_tracer
+
+# only the fields used by to_event and the event store are requested, which makes responses a fraction of the size
+EVENT_FIELDS = 'items(id,status,summary,start,end,updated),nextPageToken,nextSyncToken'
+MAX_RESULTS = 2500  # largest page size allowed by events().list
+# A full sync fetches this far past the end of the calendar window, and is repeated once the window moves past it,
+# or once a calendar holds more than MAX_STORED_EVENTS events, e.g. after many changes far in the future.
+SYNC_AHEAD = dt.timedelta(weeks=8)
+MAX_STORED_EVENTS = 2000
+# The Calendar v3 discovery document, trimmed to calendarList.list and events.list and the schemas they use, without
+# descriptions. Building the service from it needs no network round trip and parses a fraction of the full schema.
+# Regenerate it from googleapiclient's discovery_cache/documents/calendar.v3.json if other methods are needed.
+DISCOVERY_DOCUMENT = 'calendar_discovery.json'
 
 
 class GcalHelper:
 
-    def __init__(self):
+    def __init__(self, maxConcurrency=4, creds=None):
         self.logger = logging.getLogger('maginkcal')
-        # Initialise the Google Calendar using the provided credentials and token
-        SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+        self.maxConcurrency = maxConcurrency
+        self.threadLocal = threading.local()
+        # Initialise the Google Calendar using the given credentials, or the ones kept in token.json
         self.currPath = str(pathlib.Path(__file__).parent.absolute())
 
-        creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists(self.currPath + '/token.pickle'):
-            with open(self.currPath + '/token.pickle', 'rb') as token:
-                creds = pickle.load(token)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.currPath + '/credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(self.currPath + '/token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-
-        self.service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+        if creds is None:
+            with get_tracer().stage('oauth_load'):
+                creds = CredentialStore(self.currPath).get_credentials()
+        self.creds = creds
+        self.service = self.build_service()
+
+    def build_service(self):
+        documentPath = self.currPath + '/' + DISCOVERY_DOCUMENT
+        if not os.path.exists(documentPath):
+            return build('calendar', 'v3', credentials=self.creds, cache_discovery=False)
+        with open(documentPath, 'r') as documentFile:
+            return build_from_document(documentFile.read(), credentials=self.creds)
+
+    def get_http(self):
+        # httplib2 connections are not thread-safe, so each fetch thread gets its own authorised connection, with the
+        # same socket timeout as the one build() would have created
+        if not hasattr(self.threadLocal, 'http'):
+            self.threadLocal.http = google_auth_httplib2.AuthorizedHttp(self.creds, http=build_http())
+        return self.threadLocal.http
+
+    def map_calendars(self, fetch, calendars):
+        """
+        Run fetch(cal) for every calendar concurrently, up to maxConcurrency at a time, and return the results in the
+        order of calendars. The fetches run in daemon threads rather than a ThreadPoolExecutor, whose threads are
+        joined when the interpreter exits, so that a fetch still running past its deadline never holds up the exit.
+        The first error, in calendar order, is raised once all fetches have finished.
+        """
+        def timed_fetch(cal):
+            start = time.perf_counter()
+            result = fetch(cal)
+            self.logger.info('Calendar {} fetched in {:.3f}s'.format(cal, time.perf_counter() - start))
+            return result
+
+        pending = queue.Queue()
+        for index, cal in enumerate(calendars):
+            pending.put((index, cal))
+        results = [None] * len(calendars)
+        errors = [None] * len(calendars)
+
+        def run():
+            while True:
+                try:
+                    index, cal = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[index] = timed_fetch(cal)
+                except Exception as e:
+                    errors[index] = e
+
+        threads = [threading.Thread(target=run, daemon=True)
+                   for _ in range(max(1, min(self.maxConcurrency, len(calendars))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
 
     def list_calendars(self):
         # helps to retrieve ID for calendars within the account
@@ -92,44 +152,119 @@ class GcalHelper:
             return eventList
 
         self.logger.info('Retrieving events between ' + minTimeStr + ' and ' + maxTimeStr + '...')
-        events_result = []
-        for cal in calendars:
-            events_result.append(
-                self.service.events().list(calendarId=cal, timeMin=minTimeStr,
-                                           timeMax=maxTimeStr, singleEvents=True,
-                                           orderBy='startTime').execute()
-            )
+        events_result = self.map_calendars(
+            lambda cal: list(self.list_event_pages(cal, timeMin=minTimeStr, timeMax=maxTimeStr, orderBy='startTime')),
+            calendars)
 
         events = []
-        for eve in events_result:
-            events += eve.get('items', [])
+        for pages in events_result:
+            for eve in pages:
+                events += eve.get('items', [])
 
         if not events:
             self.logger.info('No upcoming events found.')
         for event in events:
-            # extracting and converting events data into a new list
-            newEvent = {}
-            newEvent['summary'] = event['summary']
-
-            if event['start'].get('dateTime') is None:
-                newEvent['allday'] = True
-                newEvent['startDatetime'] = self.to_datetime(event['start'].get('date'), localTZ)
-            else:
-                newEvent['allday'] = False
-                newEvent['startDatetime'] = self.to_datetime(event['start'].get('dateTime'), localTZ)
-
-            if event['end'].get('dateTime') is None:
-                newEvent['endDatetime'] = self.adjust_end_time(self.to_datetime(event['end'].get('date'), localTZ),
-                                                               localTZ)
-            else:
-                newEvent['endDatetime'] = self.adjust_end_time(self.to_datetime(event['end'].get('dateTime'), localTZ),
-                                                               localTZ)
-
-            newEvent['updatedDatetime'] = self.to_datetime(event['updated'], localTZ)
-            newEvent['isUpdated'] = self.is_recent_updated(newEvent['updatedDatetime'], thresholdHours)
-            newEvent['isMultiday'] = self.is_multiday(newEvent['startDatetime'], newEvent['endDatetime'])
-            eventList.append(newEvent)
+            eventList.append(self.to_event(event, localTZ, thresholdHours))
+
+        # We need to sort eventList because the event will be sorted in "calendar order" instead of hours order
+        eventList = sorted(eventList, key=lambda k: k.startDatetime)
+        return eventList
+
+    def to_event(self, event, localTZ, thresholdHours):
+        # extracting and converting events data into an Event record
+        if event['start'].get('dateTime') is None:
+            allday = True
+            startDatetime = self.to_datetime(event['start'].get('date'), localTZ)
+        else:
+            allday = False
+            startDatetime = self.to_datetime(event['start'].get('dateTime'), localTZ)
+
+        if event['end'].get('dateTime') is None:
+            endDatetime = self.adjust_end_time(self.to_datetime(event['end'].get('date'), localTZ), localTZ)
+        else:
+            endDatetime = self.adjust_end_time(self.to_datetime(event['end'].get('dateTime'), localTZ), localTZ)
+
+        updatedDatetime = self.to_datetime(event['updated'], localTZ)
+        return Event(event['summary'], allday, startDatetime, endDatetime, updatedDatetime,
+                     self.is_recent_updated(updatedDatetime, thresholdHours),
+                     self.is_multiday(startDatetime, endDatetime))
+
+    def list_event_pages(self, cal, **kwargs):
+        # generator that follows nextPageToken and yields every page of events().list results for the calendar
+        pageToken = None
+        while True:
+            result = self.service.events().list(calendarId=cal, singleEvents=True, maxResults=MAX_RESULTS,
+                                                fields=EVENT_FIELDS, pageToken=pageToken,
+                                                **kwargs).execute(http=self.get_http())
+            yield result
+            pageToken = result.get('nextPageToken')
+            if not pageToken:
+                return
+
+    def fetch_into_store(self, store, cal, **kwargs):
+        # apply every page of results to the store, the nextSyncToken only comes with the last page
+        fetched = 0
+        for result in self.list_event_pages(cal, **kwargs):
+            items = result.get('items', [])
+            fetched += len(items)
+            store.apply(cal, items, result.get('nextSyncToken'))
+        return fetched
+
+    def sync_events(self, calendars, startDatetime, endDatetime, localTZ, thresholdHours):
+        """
+        Incremental version of retrieve_events. Events are kept in event_store.json together with each calendar's
+        nextSyncToken, so after the first run only the changes since the last sync are requested from the API.
+        The store is resynced in full when the token has expired (410 Gone), the window has moved outside the last
+        full sync, or the calendar holds more than MAX_STORED_EVENTS events.
+        """
+        store = EventStore(self.currPath + '/event_store.json')
+        minTimeStr = startDatetime.isoformat()
+        maxTimeStr = endDatetime.isoformat()
+        self.logger.info('Syncing events between ' + minTimeStr + ' and ' + maxTimeStr + '...')
+
+        def is_synced(state):
+            return (state and state['syncToken'] and state.get('timeMax')
+                    and self.to_datetime(state['timeMin'], localTZ) <= startDatetime
+                    and self.to_datetime(state['timeMax'], localTZ) >= endDatetime
+                    and len(state['events']) <= MAX_STORED_EVENTS)
+
+        def sync_calendar(cal):
+            state = store.get(cal)
+            fetched = None
+            if is_synced(state):
+                try:
+                    fetched = self.fetch_into_store(store, cal, syncToken=state['syncToken'])
+                except HttpError as e:
+                    if e.resp.status != 410:
+                        raise
+                    self.logger.info('Sync token for {} has expired, doing a full sync'.format(cal))
+            if fetched is None:
+                # timeMin and timeMax cannot be sent with a syncToken, so the later changes are not bounded by them
+                syncMaxStr = (endDatetime + SYNC_AHEAD).isoformat()
+                store.reset(cal, minTimeStr, syncMaxStr)
+                fetched = self.fetch_into_store(store, cal, timeMin=minTimeStr, timeMax=syncMaxStr)
+
+            cached = max(len(store.events(cal)) - fetched, 0)
+            self.logger.info('{}: {} events fetched, {} from cache'.format(cal, fetched, cached))
+            return fetched, cached
+
+        counts = self.map_calendars(sync_calendar, calendars)
+        totalFetched = sum(fetched for fetched, cached in counts)
+        totalCached = sum(cached for fetched, cached in counts)
+
+        eventList = []
+        for cal in calendars:
+            for event in store.events(cal):
+                newEvent = self.to_event(event, localTZ, thresholdHours)
+                if newEvent.endDatetime >= startDatetime and newEvent.startDatetime <= endDatetime:
+                    eventList.append(newEvent)
+
+        store.save(startDatetime)
+        self.logger.info('Sync complete: {} events fetched, {} from cache'.format(totalFetched, totalCached))
+
+        if not eventList:
+            self.logger.info('No upcoming events found.')
 
         # We need to sort eventList because the event will be sorted in "calendar order" instead of hours order
-        eventList = sorted(eventList, key=lambda k: k['startDatetime'])
-        return eventList
\ No newline at end of file
+        eventList = sorted(eventList, key=lambda k: k.startDatetime)
+        return eventList
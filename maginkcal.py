@@ -1,26 +1,33 @@
 import json
 import logging
 import sys
+import threading
+import time
+import concurrent.futures
 import datetime as dt
-from render.render import RenderHelper
-#from display.display import DisplayHelper  # Ensure you have the correct import for DisplayHelper
-from pytz import timezone
-from gcal.gcal import GcalHelper
-from power.power import PowerHelper
 import os
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from PIL import Image
-from display.epd7in5_V2 import EPD  # Replace with your display's driver
+# Only light modules are imported up front. The Google client, imgkit, PIL, pytz and the display driver are imported
+# by the stage that needs them, which keeps startup fast on a Pi Zero and skips them entirely when a stage is not run.
+from gcal.eventcache import EventCache
+from power.power import PowerHelper
+from display.framecache import FrameCache
+from display.refreshpolicy import RefreshPolicy
+from display.panel import PanelHelper
+from metrics.tracer import get_tracer
 
-def refresh_token(credentials_path):
-    creds = Credentials.from_authorized_user_file(credentials_path)
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-        with open(credentials_path, 'w') as token:
-            token.write(creds.to_json())
-    return creds
+def run_in_background(func, *args):
+    # Run func in a daemon thread and return a Future for its result. Daemon threads are used instead of an executor
+    # so that a stage which overruns its deadline, such as a slow calendar fetch, never holds up the exit.
+    future = concurrent.futures.Future()
 
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
 
 
 def main():
@@ -30,44 +37,81 @@ def main():
     logger.addHandler(logging.StreamHandler(sys.stdout))  # print logger to stdout
     logger.setLevel(logging.INFO)
     logger.info("Starting daily calendar update")
+    tracer = get_tracer()
+    traceFile = None  # set once the configuration is loaded
+    # stored in the run history next to the stage timings; refreshed is the kind of refresh the panel actually did
+    runInfo = {'error': None, 'refreshed': None}
 
     try:
-        # Load configuration from config.json
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        logger.info(f"Loading configuration from {config_path}")
+        with tracer.stage('config_load'):
+            import pytz
+            # Load configuration from config.json
+            config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+            logger.info(f"Loading configuration from {config_path}")
         
-        # Debugging: Check if the file exists
-        if not os.path.exists(config_path):
-            logger.error(f"Configuration file {config_path} does not exist.")
-            sys.exit(1)
+            # Debugging: Check if the file exists
+            if not os.path.exists(config_path):
+                logger.error(f"Configuration file {config_path} does not exist.")
+                sys.exit(1)
         
-        with open(config_path, 'r') as config_file:
-            config = json.load(config_file)
-        logger.info(f"Made it here configuration from {config_path}")
-
-        # Extract values from the configuration
-        displayTZ = timezone(config['displayTZ'])
-        thresholdHours = config['thresholdHours']
-        maxEventsPerDay = config['maxEventsPerDay']
-        isDisplayToScreen = config['isDisplayToScreen']
-        isShutdownOnComplete = config['isShutdownOnComplete']
-        batteryDisplayMode = config['batteryDisplayMode']
-        weekStartDay = config['weekStartDay']
-        dayOfWeekText = config['dayOfWeekText']
-        screenWidth = config['screenWidth']
-        screenHeight = config['screenHeight']
-        imageWidth = config['imageWidth']
-        imageHeight = config['imageHeight']
-        rotateAngle = config['rotateAngle']
-        is24hour = config['is24h']
-        calendars = config['calendars']
-        logger.info(f"Made it hereerereerer Loading configuration from {config_path}")
-
-          # Initialize e-paper display
+            with open(config_path, 'r') as config_file:
+                config = json.load(config_file)
+            logger.info(f"Made it here configuration from {config_path}")
+
+            # Extract values from the configuration
+            displayTZ = pytz.timezone(config['displayTZ'])
+            thresholdHours = config['thresholdHours']
+            maxEventsPerDay = config['maxEventsPerDay']
+            isDisplayToScreen = config['isDisplayToScreen']
+            isShutdownOnComplete = config['isShutdownOnComplete']
+            batteryDisplayMode = config['batteryDisplayMode']
+            weekStartDay = config['weekStartDay']
+            dayOfWeekText = config['dayOfWeekText']
+            screenWidth = config['screenWidth']
+            screenHeight = config['screenHeight']
+            imageWidth = config['imageWidth']
+            imageHeight = config['imageHeight']
+            rotateAngle = config['rotateAngle']
+            is24hour = config['is24h']
+            calendars = config['calendars']
+            isSaveDebugImages = config.get('isSaveDebugImages', False)
+            renderBackend = config.get('renderBackend', 'imgkit')
+            isIncrementalSync = config.get('isIncrementalSync', False)
+            maxConcurrentFetches = config.get('maxConcurrentFetches', 4)
+            isCacheFirst = config.get('isCacheFirst', False)
+            fetchTimeoutSeconds = config.get('fetchTimeoutSeconds', 60)
+            partialRefreshLimit = config.get('partialRefreshLimit', 0)
+            isEarlyPanelInit = config.get('isEarlyPanelInit', False)
+            clearPolicy = config.get('clearPolicy', 'weekly')
+            clearAfterPartials = config.get('clearAfterPartials', 1)
+            calibrateCycles = config.get('calibrateCycles', 0)
+            busyTimeoutSeconds = config.get('busyTimeoutSeconds', 30)
+            epdBackend = config.get('epdBackend', '')  # "" detects the platform on first use of the display
+            traceFile = config.get('traceFile', 'trace.jsonl')  # one JSON line of stage timings per run, "" to disable
+            tokenRefreshAheadMinutes = config.get('tokenRefreshAheadMinutes', 0)
+            logger.info(f"Made it hereerereerer Loading configuration from {config_path}")
+
+        # Load the Google credentials, refreshing the access token if it is about to expire, while the time is synced
+        # and the display is set up, so the fetch does not have to wait for the token endpoint
+        def load_credentials():
+            with tracer.stage('oauth_load'):
+                from gcal.credentialstore import CredentialStore
+                credentialStore = CredentialStore(os.path.join(os.path.dirname(__file__), 'gcal'))
+                return credentialStore, credentialStore.get_credentials()
+
+        credentialFuture = run_in_background(load_credentials)
+
+        # The e-paper display is only initialised once there is a new frame to show, unless isEarlyPanelInit is set
+        from display import epdconfig
+        from display.epd7in5_V2 import EPD  # Replace with your display's driver
+        epdconfig.set_backend(epdBackend)
         epd = EPD()
-        epd.init()
-        epd.Clear()
-        logger.info("E-paper display initialized successfully.")
+        epd.busyTimeout = busyTimeoutSeconds
+
+        frameCache = FrameCache(os.path.join(os.path.dirname(__file__), 'display', 'last_frame'))
+        refreshPolicy = RefreshPolicy(os.path.join(os.path.dirname(__file__), 'display', 'refresh_state.json'),
+                                      clearPolicy, weekStartDay, clearAfterPartials, calibrateCycles)
+        panel = PanelHelper(epd, frameCache, refreshPolicy, partialRefreshLimit)
 
         # Establish current date and time information
         logger.info("Initializing PowerHelper")
@@ -75,13 +119,10 @@ def main():
         logger.info("PowerHelper initialized")
 
         logger.info("Syncing time with PowerHelper")
-        powerService.sync_time()
+        with tracer.stage('time_sync'):
+            powerService.sync_time()
         logger.info("Time synced with PowerHelper")
 
-        logger.info("Getting battery level from PowerHelper")
-        currBatteryLevel = powerService.get_battery()
-        logger.info('Battery level at start: {:.3f}'.format(currBatteryLevel))
-
         currDatetime = dt.datetime.now(displayTZ)
         logger.info("Time synchronised to {}".format(currDatetime))
         currDate = currDatetime.date()
@@ -90,51 +131,124 @@ def main():
         calStartDatetime = displayTZ.localize(dt.datetime.combine(calStartDate, dt.datetime.min.time()))
         calEndDatetime = displayTZ.localize(dt.datetime.combine(calEndDate, dt.datetime.max.time()))
 
+        if isEarlyPanelInit and isDisplayToScreen:
+            # Power up the panel while everything else runs; if it gets cleared, the refresh can no longer be skipped
+            panel.prepareFuture = run_in_background(panel.prepare, currDate)
+
+        eventCache = EventCache(os.path.join(os.path.dirname(__file__), 'gcal', 'events_cache.pickle'))
 
         # Using Google Calendar to retrieve all events within start and end date (inclusive)
-        start = dt.datetime.now()
-        gcalService = GcalHelper()
-        eventList = gcalService.retrieve_events(calendars, calStartDatetime, calEndDatetime, displayTZ, thresholdHours)
-        logger.info("Calendar events retrieved in " + str(dt.datetime.now() - start))
-
-        # Populate dictionary with information to be rendered on e-ink display
-        calDict = {'events': eventList, 'calStartDate': calStartDate, 'today': currDate, 'lastRefresh': currDatetime,
-                   'batteryLevel': currBatteryLevel, 'batteryDisplayMode': batteryDisplayMode,
-                   'dayOfWeekText': dayOfWeekText, 'weekStartDay': weekStartDay, 'maxEventsPerDay': maxEventsPerDay,
-                   'is24hour': is24hour}
-
-        # Instantiate RenderHelper with the configuration values
-        render_helper = RenderHelper(imageWidth, imageHeight, rotateAngle)
-        calBlackImage, calRedImage = render_helper.process_inputs(calDict)
-        calBlackImage.save("blackimg.png")
-        calRedImage.save("redimg.png")
-        logger.info("Rendered calendar images saved for verification.")
-
-        if calBlackImage.size != (epd.width, epd.height):
-            logger.info("Resizing image to match e-paper resolution...")
-            calBlackImage = calBlackImage.resize((epd.width, epd.height))
-        calBlackImage = calBlackImage.convert('1')  # Convert to 1-bit black-and-white mode
-
-        if isDisplayToScreen:
-            buffer = epd.getbuffer(calBlackImage)
-            epd.display(buffer)
-            #if currDate.weekday() == weekStartDay:
-                # calibrate display once a week to prevent ghosting
-                #displayService.calibrate(cycles=0)  # to calibrate in production
-        logger.info("Calendar image displayed successfully.")
+        def fetch_events():
+            start = dt.datetime.now()
+            with tracer.stage('fetch'):
+                from gcal.gcal import GcalHelper
+                gcalService = GcalHelper(maxConcurrentFetches, credentialFuture.result()[1])
+                if isIncrementalSync:
+                    eventList = gcalService.sync_events(calendars, calStartDatetime, calEndDatetime, displayTZ,
+                                                        thresholdHours)
+                else:
+                    eventList = gcalService.retrieve_events(calendars, calStartDatetime, calEndDatetime, displayTZ,
+                                                            thresholdHours)
+            logger.info("Calendar events retrieved in " + str(dt.datetime.now() - start))
+            eventCache.save(eventList)
+            return eventList
+
+        # Instantiate the renderer selected in the configuration: "imgkit" (HTML template) or "pillow" (native)
+        def create_renderer():
+            with tracer.stage('renderer_setup'):
+                if renderBackend == 'pillow':
+                    from render.native import NativeRenderHelper
+                    return NativeRenderHelper(imageWidth, imageHeight, rotateAngle, isSaveDebugImages)
+                from render.render import RenderHelper
+                return RenderHelper(imageWidth, imageHeight, rotateAngle, isSaveDebugImages)
+
+        def read_battery():
+            with tracer.stage('battery_read'):
+                return powerService.get_battery()
+
+        # The battery read, the calendar fetch and the renderer setup (template or fonts) all run concurrently
+        fetchDeadline = time.monotonic() + fetchTimeoutSeconds
+        fetchFuture = run_in_background(fetch_events)
+        batteryFuture = run_in_background(read_battery)
+        rendererFuture = run_in_background(create_renderer)
 
-        # Put the display to sleep
-        epd.sleep()
-        logger.info("E-paper display put to sleep.")
+        logger.info("Getting battery level from PowerHelper")
+        currBatteryLevel = batteryFuture.result()
+        runInfo['batteryStart'] = currBatteryLevel
+        logger.info('Battery level at start: {:.3f}'.format(currBatteryLevel))
+
+        def show_calendar(eventList):
+            # Populate dictionary with information to be rendered on e-ink display
+            calDict = {'events': eventList, 'calStartDate': calStartDate, 'today': currDate,
+                       'lastRefresh': currDatetime, 'batteryLevel': currBatteryLevel,
+                       'batteryDisplayMode': batteryDisplayMode, 'dayOfWeekText': dayOfWeekText,
+                       'weekStartDay': weekStartDay, 'maxEventsPerDay': maxEventsPerDay, 'is24hour': is24hour}
+
+            calBlackImage, calRedImage = rendererFuture.result().process_inputs(calDict)
+            if isSaveDebugImages:
+                calBlackImage.save("blackimg.png")
+                calRedImage.save("redimg.png")
+                logger.info("Rendered calendar images saved for verification.")
+
+            if calBlackImage.size != (epd.width, epd.height):
+                logger.info("Resizing image to match e-paper resolution...")
+                calBlackImage = calBlackImage.resize((epd.width, epd.height))
+            calBlackImage = calBlackImage.convert('1')  # Convert to 1-bit black-and-white mode
+
+            if isDisplayToScreen:
+                with tracer.stage('getbuffer'):
+                    buffer = epd.getbuffer(calBlackImage)
+                panel.show(buffer, currDate)
+            logger.info("Calendar image displayed successfully.")
+
+        cachedEvents = eventCache.load(calStartDatetime, calEndDatetime) if isCacheFirst else None
+        if cachedEvents is None:
+            show_calendar(fetchFuture.result())
+        else:
+            # Draw the last known events straight away, then give the fetch a bounded amount of time to finish
+            logger.info("Rendering {} cached events while fetching fresh ones".format(len(cachedEvents)))
+            show_calendar(cachedEvents)
+            try:
+                fetchedEvents = fetchFuture.result(max(fetchDeadline - time.monotonic(), 0))
+            except concurrent.futures.TimeoutError:
+                logger.info("Calendar fetch did not finish within {}s, keeping cached events".format(
+                    fetchTimeoutSeconds))
+            except Exception as e:
+                logger.error("Calendar fetch failed, keeping cached events: {}".format(e))
+            else:
+                # only compare what is drawn, isUpdated changes by itself as thresholdHours pass
+                if [event.render_key() for event in fetchedEvents] == [event.render_key() for event in cachedEvents]:
+                    logger.info("Fetched events match the cached events, no redraw needed")
+                else:
+                    logger.info("Fetched events differ from the cached events, redrawing")
+                    show_calendar(fetchedEvents)
 
-        currBatteryLevel = powerService.get_battery()
+        # Put the display to sleep
+        panel.sleep()
+        runInfo['refreshed'] = panel.refreshed
+
+        # Refresh the access token now if it would expire before the next run, so that run can use the stored one
+        if tokenRefreshAheadMinutes and credentialFuture.done() and credentialFuture.exception() is None:
+            credentialStore, creds = credentialFuture.result()
+            try:
+                with tracer.stage('token_refresh'):
+                    credentialStore.refresh(creds, dt.timedelta(minutes=tokenRefreshAheadMinutes))
+            except Exception as e:
+                logger.error("Could not refresh the OAuth access token ahead of the next run: {}".format(e))
+
+        currBatteryLevel = read_battery()
+        runInfo['batteryEnd'] = currBatteryLevel
         logger.info('Battery level at end: {:.3f}'.format(currBatteryLevel))
         # Check if configured to shutdown safely
         logger.info("Checking if configured to shutdown safely - Current hour: {}".format(currDatetime.hour))
 
     except Exception as e:
         logger.error("An error occurred: {}".format(e))
+        runInfo['error'] = str(e)
         sys.exit(1)
+    finally:
+        if traceFile:
+            tracer.write(os.path.join(os.path.dirname(__file__), traceFile), **runInfo)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
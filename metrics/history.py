@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This reads the run history kept in the trace file (one JSON line per boot, see metrics/tracer.py) and estimates
+where the battery goes, so that we can see which optimisations actually extend the battery life.
+
+Start it with: python3 -m metrics.history [trace file]
+The trace file and the battery capacity ("batteryCapacityMah") are otherwise taken from config.json.
+
+The PiSugar only reports the battery level in percent, so the energy of a single run is too coarse to be useful.
+The report therefore works on totals over the history:
+- the drain during runs (level at start minus level at end) is split across the main-thread stages of each run in
+  proportion to their share of the run's wall time, assuming the Pi draws a roughly constant current while it is
+  awake; the time not covered by any stage is reported as "other"
+- stages that ran in background threads overlap the main-thread ones, so their time is already paid for there;
+  they are listed separately, with their time only
+- the drain between runs (level at the end of one run minus the level at the start of the next) is the standby cost
+- days to empty extrapolates the drain per day since the last charge from the current level
+"""
+
+import datetime as dt
+import json
+import os
+import pathlib
+import sys
+
+DEFAULT_CAPACITY_MAH = 1200  # PiSugar 2 and PiSugar 3 for the Pi Zero
+SUMMARY_STAGES = ('busy_wait', 'spi_transfer')  # already included in the panel stages they summarise
+# stages that always ran in background threads, for traces written before stages were marked with "background"
+BACKGROUND_STAGES = ('oauth_load', 'fetch', 'battery_read', 'renderer_setup')
+
+
+class RunHistory:
+
+    def __init__(self, path, capacityMah=DEFAULT_CAPACITY_MAH):
+        self.path = path
+        self.capacityMah = capacityMah
+        self.runs = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as historyFile:
+                for line in historyFile:
+                    try:
+                        self.runs.append(json.loads(line))
+                    except ValueError:
+                        continue  # a line cut short by a power failure
+        for run in self.runs:
+            run['start'] = dt.datetime.fromisoformat(run['start'])
+
+    def get_measured_runs(self):
+        # runs with a valid battery reading at both ends; get_battery returns -1 when the PiSugar does not answer
+        return [run for run in self.runs if run.get('batteryStart', -1) >= 0 and run.get('batteryEnd', -1) >= 0]
+
+    def get_since_last_charge(self):
+        # the measured runs after the last time the battery level went up between two runs
+        runs = self.get_measured_runs()
+        for i in range(len(runs) - 1, 0, -1):
+            if runs[i]['batteryStart'] > runs[i - 1]['batteryEnd']:
+                return runs[i:]
+        return runs
+
+    def to_mah(self, percent):
+        return percent / 100 * self.capacityMah
+
+    def get_stage_energy(self):
+        """
+        Estimate the average energy per run of each main-thread stage, in mAh. Returns a dict of stage name to
+        (mAh per run, seconds per run), a dict of background stage name to seconds per run, and the number of runs
+        they are based on.
+        """
+        runs = [run for run in self.get_measured_runs() if run.get('wall', 0) > 0]
+        totals = {}
+        backgroundTotals = {}
+        for run in runs:
+            drain = self.to_mah(max(run['batteryStart'] - run['batteryEnd'], 0))
+            staged = 0
+            for stage in run.get('stages', []):
+                if stage['name'] in SUMMARY_STAGES:
+                    continue
+                if stage.get('background', stage['name'] in BACKGROUND_STAGES):
+                    backgroundTotals[stage['name']] = backgroundTotals.get(stage['name'], 0) + stage['wall']
+                    continue
+                energy, seconds = totals.get(stage['name'], (0, 0))
+                totals[stage['name']] = (energy + drain * stage['wall'] / run['wall'], seconds + stage['wall'])
+                staged += stage['wall']
+            energy, seconds = totals.get('other', (0, 0))
+            other = max(run['wall'] - staged, 0)
+            totals['other'] = (energy + drain * other / run['wall'], seconds + other)
+        stageEnergy = {name: (energy / len(runs), seconds / len(runs)) for name, (energy, seconds) in totals.items()}
+        backgroundSeconds = {name: seconds / len(runs) for name, seconds in backgroundTotals.items()}
+        return stageEnergy, backgroundSeconds, len(runs)
+
+    def get_standby_drain(self):
+        # average mAh lost between the end of one run and the start of the next, excluding charges
+        runs = self.get_measured_runs()
+        gaps = [runs[i - 1]['batteryEnd'] - runs[i]['batteryStart'] for i in range(1, len(runs))]
+        gaps = [gap for gap in gaps if gap >= 0]
+        return self.to_mah(sum(gaps) / len(gaps)) if gaps else None
+
+    def get_days_to_empty(self):
+        """
+        Returns (days to empty, mAh per day) extrapolated from the drain since the last charge, or None when the
+        history is too short to tell.
+        """
+        runs = self.get_since_last_charge()
+        if len(runs) < 2:
+            return None
+        days = (runs[-1]['start'] - runs[0]['start']).total_seconds() / 86400
+        drain = runs[0]['batteryStart'] - runs[-1]['batteryEnd']
+        if days <= 0 or drain <= 0:
+            return None
+        return runs[-1]['batteryEnd'] / (drain / days), self.to_mah(drain / days)
+
+    def report(self):
+        lines = ['{} runs in {}'.format(len(self.runs), self.path)]
+        for mode in ('full', 'partial', None):
+            runs = [run for run in self.get_measured_runs() if run.get('refreshed') == mode]
+            if runs:
+                drain = sum(self.to_mah(run['batteryStart'] - run['batteryEnd']) for run in runs) / len(runs)
+                lines.append('{:<16}{:>5} runs{:>9.2f} mAh per run'.format(
+                    '{} refresh'.format(mode) if mode else 'no refresh', len(runs), drain))
+
+        stageEnergy, backgroundSeconds, runCount = self.get_stage_energy()
+        if stageEnergy:
+            lines.append('')
+            lines.append('Average per run over {} runs with battery readings:'.format(runCount))
+            lines.append('{:<20}{:>10}{:>10}'.format('stage', 'seconds', 'mAh'))
+            for name, (energy, seconds) in sorted(stageEnergy.items(), key=lambda item: -item[1][0]):
+                lines.append('{:<20}{:>10.2f}{:>10.3f}'.format(name, seconds, energy))
+        if backgroundSeconds:
+            lines.append('')
+            lines.append('In background threads, overlapping the stages above:')
+            for name, seconds in sorted(backgroundSeconds.items(), key=lambda item: -item[1]):
+                lines.append('{:<20}{:>10.2f}'.format(name, seconds))
+
+        standby = self.get_standby_drain()
+        if standby is not None:
+            lines.append('')
+            lines.append('Standby between runs: {:.2f} mAh'.format(standby))
+        daysToEmpty = self.get_days_to_empty()
+        if daysToEmpty is None:
+            lines.append('Not enough battery readings since the last charge to estimate the days to empty.')
+        else:
+            lines.append('Drain since the last charge: {:.1f} mAh per day, empty in about {:.1f} days'.format(
+                daysToEmpty[1], daysToEmpty[0]))
+        return '\n'.join(lines)
+
+
+def main():
+    rootPath = pathlib.Path(__file__).parent.parent.absolute()
+    with open(rootPath / 'config.json', 'r') as configFile:
+        config = json.load(configFile)
+    path = sys.argv[1] if len(sys.argv) > 1 else str(rootPath / (config.get('traceFile') or 'trace.jsonl'))
+    print(RunHistory(path, config.get('batteryCapacityMah', DEFAULT_CAPACITY_MAH)).report())
+
+
+if __name__ == '__main__':
+    main()
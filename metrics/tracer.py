@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This records how long each stage of a calendar refresh takes, so that regressions can be tracked across boots.
+For every stage it keeps the wall time, the CPU time of the thread that ran it plus any child processes it started
+(such as wkhtmltoimage), and the peak RSS of the process once the stage finished. At the end of a run all stages
+are appended to the trace file as a single JSON line, which also serves as the run history read by
+metrics/history.py.
+
+Stages can run in background threads, so their wall times may overlap and do not add up to the run time. Each
+stage records whether it ran in a background thread, so that the stages of the main thread can be told apart.
+"""
+
+import contextlib
+import datetime as dt
+import json
+import logging
+import resource
+import threading
+import time
+
+_tracer = None
+
+
+def get_tracer():
+    # one tracer per process, shared by every module like the 'maginkcal' logger
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Tracer:
+
+    def __init__(self):
+        self.logger = logging.getLogger('maginkcal')
+        self.lock = threading.Lock()
+        self.startTime = dt.datetime.now(dt.timezone.utc)
+        self.startWall = time.perf_counter()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the body of the with statement as the stage called name. The record is yielded so that callers can
+        attach extra fields to it, and is kept even when the body raises.
+        """
+        record = {'name': name, 'background': threading.current_thread() is not threading.main_thread()}
+        wallStart = time.perf_counter()
+        cpuStart = time.thread_time() + children_cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = round(time.perf_counter() - wallStart, 4)
+            record['cpu'] = round(time.thread_time() + children_cpu_time() - cpuStart, 4)
+            record['peakRssMb'] = round(peak_rss_mb(), 1)
+            with self.lock:
+                self.stages.append(record)
+
+    def add(self, name, wall, **fields):
+        # record a stage that was measured elsewhere, e.g. the busy waits timed by the EPD driver
+        record = dict(name=name, wall=round(wall, 4), **fields)
+        with self.lock:
+            self.stages.append(record)
+
+    def write(self, path, **fields):
+        """
+        Append this run as one JSON line to path, along with any extra fields given, e.g. the error that ended it.
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        with self.lock:
+            run = {'start': self.startTime.isoformat(),
+                   'wall': round(time.perf_counter() - self.startWall, 4),
+                   'cpu': round(usage.ru_utime + usage.ru_stime + children_cpu_time(), 4),
+                   'peakRssMb': round(peak_rss_mb(), 1),
+                   'stages': list(self.stages)}
+        run.update(fields)
+        # a single write call in append mode, so that a line is never interleaved with another run
+        with open(path, 'a') as traceFile:
+            traceFile.write(json.dumps(run, default=str) + '\n')
+        self.logger.info('Run trace written to {}'.format(path))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This script draws the calendar directly with PIL.ImageDraw, as an alternative to rendering calendar_template.html
+through imgkit/wkhtmltoimage. It follows the same layout (today's events header, battery icon, day-of-week header
+and a 5-week grid of events) using the bundled Quattrocento fonts, and is much lighter to run on a Pi Zero.
+"""
+
+from datetime import timedelta
+from PIL import Image, ImageDraw, ImageFont
+from render.render import RenderHelper
+
+WHITE = (255, 255, 255)
+BLACK = (33, 37, 41)  # body text colour in styles.css
+MUTED = (108, 117, 125)  # .text-muted
+RULE = (222, 226, 230)
+
+# top offset of each battery level within battery.png, as used by the battery classes in styles.css
+BATTERY_OFFSETS = {'battery80': 0, 'battery60': 44, 'battery40': 89, 'battery20': 134, 'battery0': 178}
+BATTERY_SIZE = (53, 27)
+
+
+class NativeRenderHelper(RenderHelper):
+
+    def __init__(self, width, height, angle, saveDebugImages=False):
+        super().__init__(width, height, angle, saveDebugImages)
+        self.padding = 8
+        # the basic layout engine is plenty for these fonts, and much faster than raqm at measuring text
+        self.headerFont = self.load_font('Quattrocento-Regular.ttf', 24)
+        self.dayNameFont = self.load_font('Quattrocento-Bold.ttf', 22)
+        self.dateFont = self.load_font('Quattrocento-Bold.ttf', 18)
+        self.eventFont = self.load_font('Quattrocento-Regular.ttf', 12)
+
+    def load_font(self, name, size):
+        return ImageFont.truetype(self.currPath + '/' + name, size, layout_engine=ImageFont.Layout.BASIC)
+
+    def fit_text(self, text, font, maxWidth):
+        # trim text with an ellipsis so it fits in maxWidth, like "text-overflow: ellipsis" in styles.css
+        if font.getlength(text) <= maxWidth:
+            return text
+        # binary search for the longest prefix that still fits alongside the ellipsis
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if font.getlength(text[:mid] + '...') <= maxWidth:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low].rstrip() + '...'
+
+    def draw_battery(self, img, battText):
+        if battText not in BATTERY_OFFSETS:
+            return
+        top = BATTERY_OFFSETS[battText]
+        with Image.open(self.currPath + '/battery.png') as sprite:
+            icon = sprite.convert('RGBA').crop((0, top, BATTERY_SIZE[0], top + BATTERY_SIZE[1]))
+        img.paste(icon, (self.imageWidth - BATTERY_SIZE[0] - self.padding, self.padding), icon)
+
+    def process_inputs(self, calDict):
+        """
+        Draw the calendar based on the input dictionary, then split it into images.
+        """
+        with self.tracer.stage('draw'):
+            img = self.draw_calendar(calDict)
+
+        calBlackImage, calRedImage = self.process_image(img)
+        return calBlackImage, calRedImage
+
+    def draw_calendar(self, calDict):
+        """
+        Draw the calendar grid and events onto a new RGB image of the configured size.
+        """
+        # Retrieve calendar configuration
+        maxEventsPerDay = calDict['maxEventsPerDay']
+        batteryDisplayMode = calDict['batteryDisplayMode']
+        dayOfWeekText = calDict['dayOfWeekText']
+        weekStartDay = calDict['weekStartDay']
+
+        calList = self.get_cal_list(calDict)
+
+        img = Image.new('RGB', (self.imageWidth, self.imageHeight), WHITE)
+        draw = ImageDraw.Draw(img)
+        pad = self.padding
+        colWidth = (self.imageWidth - 2 * pad) / 7
+
+        # Today's events header and battery icon
+        headerHeight = 30
+        headerText = ' / '.join(event.summary for event in self.TodayEvent_List).upper()
+        headerText = self.fit_text(headerText, self.headerFont, self.imageWidth - 2 * (pad + BATTERY_SIZE[0]))
+        draw.text((self.imageWidth / 2, pad + headerHeight / 2), headerText, font=self.headerFont, fill=BLACK,
+                  anchor='mm')
+        self.draw_battery(img, self.get_batt_text(batteryDisplayMode, calDict['batteryLevel']))
+
+        # Day of week header
+        top = pad + headerHeight
+        dayNameHeight = 28
+        for i in range(7):
+            draw.text((pad + colWidth * (i + 0.5), top + dayNameHeight / 2), dayOfWeekText[(i + weekStartDay) % 7].upper(),
+                      font=self.dayNameFont, fill=BLACK, anchor='mm')
+
+        # Calendar and events
+        top += dayNameHeight
+        rowHeight = (self.imageHeight - top - pad) / 5
+        lineHeight = self.eventFont.size + 2
+        for i, day_events in enumerate(calList):
+            currDate = calDict['calStartDate'] + timedelta(days=i)
+            colour = MUTED if currDate.month != calDict['today'].month else BLACK
+            left = pad + colWidth * (i % 7)
+            cellTop = top + rowHeight * (i // 7)
+            if i % 7 == 0:
+                draw.line((pad, cellTop, self.imageWidth - pad, cellTop), fill=RULE)
+
+            draw.text((left + colWidth / 2, cellTop + 2), str(currDate.day), font=self.dateFont, fill=colour,
+                      anchor='mt')
+            y = cellTop + self.dateFont.size + 4
+            for event in day_events[:maxEventsPerDay]:
+                draw.text((left + 2, y), self.fit_text(event.summary, self.eventFont, colWidth - 4),
+                          font=self.eventFont, fill=colour)
+                y += lineHeight
+            if len(day_events) > maxEventsPerDay:
+                draw.text((left + 2, y), f'{len(day_events) - maxEventsPerDay} more', font=self.eventFont, fill=MUTED)
+
+        self.logger.info("Calendar drawn with the native renderer.")
+        if self.saveDebugImages:
+            img.save(self.currPath + '/calendar.png')
+        return img
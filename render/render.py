@@ -6,28 +6,39 @@ using imgkit, avoiding the need for a WebDriver. The resulting image is processe
 to extract grayscale and red portions, which are then sent to the eInk display.
 """
 
-import imgkit
+import io
 from datetime import datetime, timedelta
-from PIL import Image
+from PIL import Image, ImageChops
 import pathlib
 import logging
+from metrics.tracer import get_tracer
 
 
 class RenderHelper:
 
-    def __init__(self, width, height, angle):
+    def __init__(self, width, height, angle, saveDebugImages=False):
         self.logger = logging.getLogger('maginkcal')
+        self.tracer = get_tracer()
         self.currPath = str(pathlib.Path(__file__).parent.absolute())
         self.htmlFile = self.currPath + '/calendar.html'  # Absolute path without "file://"
         self.imageWidth = width
         self.imageHeight = height
         self.rotateAngle = angle
+        self.saveDebugImages = saveDebugImages
         self.TodayEvent_List = []
+        # Read the HTML template up front, so that it can be loaded while the calendar events are still being fetched
+        with open(self.currPath + '/calendar_template.html', 'r') as file:
+            self.calendarTemplate = file.read()
 
 
     def get_screenshot(self):
         """
-        Render the HTML file to a PNG image using imgkit.
+        Render the HTML file to a PNG image using imgkit. The PNG is kept in memory and decoded once; it is only
+        written to disk as calendar.png when debug images are enabled.
+
+        Every call starts a new wkhtmltoimage process, which pays for process start, Qt init and CSS parsing each
+        time. The calendar refreshes once per boot, so there is nothing to keep warm between renders; where render
+        time matters, the native Pillow renderer ("renderBackend": "pillow") avoids the browser altogether.
         """
         options = {
             'format': 'png',
@@ -37,28 +48,55 @@ class RenderHelper:
             'enable-local-file-access': ''  # Add this option
         }
 
-        output_file = self.currPath + '/calendar.png'
-        imgkit.from_file(self.htmlFile, output_file, options=options)
-        self.logger.info('Screenshot captured and saved to file.')
+        with self.tracer.stage('rasterize'):
+            import imgkit  # loaded here so that startup and the pillow backend never pay for it
+            pngData = imgkit.from_file(self.htmlFile, False, options=options)  # False returns the output instead
+        self.logger.info('Screenshot captured.')
+        if self.saveDebugImages:
+            with open(self.currPath + '/calendar.png', 'wb') as pngFile:
+                pngFile.write(pngData)
 
-        redimg = Image.open(output_file)  # Load the image
-        rpixels = redimg.load()  # Create the pixel map
-        blackimg = Image.open(output_file)  # Load the image again
-        bpixels = blackimg.load()  # Create the pixel map
+        return self.process_image(Image.open(io.BytesIO(pngData)))
 
-        for i in range(redimg.size[0]):  # Loop through every pixel in the image
-            for j in range(redimg.size[1]):
-                if rpixels[i, j][0] <= rpixels[i, j][1] and rpixels[i, j][0] <= rpixels[i, j][2]:  # If not red
-                    rpixels[i, j] = (255, 255, 255)  # Change it to white in the red image bitmap
-                elif bpixels[i, j][0] > bpixels[i, j][1] and bpixels[i, j][0] > bpixels[i, j][2]:  # If red
-                    bpixels[i, j] = (255, 255, 255)  # Change to white in the black image bitmap
+    def process_image(self, img):
+        """
+        Split the rendered image into its black and red planes, and rotate them for the display.
+        """
+        with self.tracer.stage('colour_split'):
+            blackimg, redimg = self.split_colours(img)
 
-        redimg = redimg.rotate(self.rotateAngle, expand=True)
-        blackimg = blackimg.rotate(self.rotateAngle, expand=True)
+            if self.rotateAngle:
+                redimg = redimg.rotate(self.rotateAngle, expand=True)
+                blackimg = blackimg.rotate(self.rotateAngle, expand=True)
 
         self.logger.info('Image colours processed. Extracted grayscale and red images.')
         return blackimg, redimg
 
+    def split_colours(self, img):
+        """
+        Separate a rendered RGB(A) image into its black and red planes in a single pass.
+
+        A pixel is red when its red channel is strictly greater than both green and blue. Red pixels are
+        whited out in the black plane, and pixels whose red channel is not above either of the other two
+        are whited out in the red plane. Anything in between is kept in both planes.
+        """
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGB')
+        r, g, b = img.split()[:3]
+        redOverGreen = ImageChops.subtract(r, g)  # r - g, clipped at 0
+        redOverBlue = ImageChops.subtract(r, b)  # r - b, clipped at 0
+
+        # not red: r <= g and r <= b, i.e. both differences are 0
+        notRedMask = ImageChops.lighter(redOverGreen, redOverBlue).point(lambda v: 255 if v == 0 else 0, '1')
+        # red: r > g and r > b, i.e. both differences are above 0
+        redMask = ImageChops.darker(redOverGreen, redOverBlue).point(lambda v: 255 if v > 0 else 0, '1')
+
+        redimg = img.copy()
+        redimg.paste((255, 255, 255), mask=notRedMask)  # Change it to white in the red image bitmap
+        blackimg = img.copy()
+        blackimg.paste((255, 255, 255), mask=redMask)  # Change to white in the black image bitmap
+        return blackimg, redimg
+
     def get_day_in_cal(self, startDate, eventDate):
         delta = eventDate - startDate
         return delta.days
@@ -81,45 +119,64 @@ class RenderHelper:
                 datetime_str = '{}{}am'.format(str(datetimeObj.hour), datetime_str)
         return datetime_str
 
-    def process_inputs(self, calDict):
+    def get_cal_list(self, calDict):
         """
-        Generate the calendar HTML based on the input dictionary, then render it to images.
+        Bucket the events into the 35 days of the calendar, and keep today's events for the header.
         """
         calList = [[] for _ in range(35)]  # List for 5 weeks of calendar days
 
-        # Retrieve calendar configuration
-        maxEventsPerDay = calDict['maxEventsPerDay']
-        batteryDisplayMode = calDict['batteryDisplayMode']
-        dayOfWeekText = calDict['dayOfWeekText']
-        weekStartDay = calDict['weekStartDay']
-        is24hour = calDict['is24hour']
-
         # Populate calendar list with events
         for event in calDict['events']:
-            idx = self.get_day_in_cal(calDict['calStartDate'], event['startDatetime'].date())
+            idx = self.get_day_in_cal(calDict['calStartDate'], event.startDatetime.date())
             if idx >= 0:
                 calList[idx].append(event)
-            if event['isMultiday']:
-                idx = self.get_day_in_cal(calDict['calStartDate'], event['endDatetime'].date())
+            if event.isMultiday:
+                idx = self.get_day_in_cal(calDict['calStartDate'], event.endDatetime.date())
                 if idx < len(calList):
                     calList[idx].append(event)
         # Filter today's events
         today = calDict['today']  # Already a date object, no need for .date()
-        self.TodayEvent_List = [event for event in calDict['events'] if event['startDatetime'].date() == today]
-
-        # Read HTML template
-        with open(self.currPath + '/calendar_template.html', 'r') as file:
-            calendar_template = file.read()
+        self.TodayEvent_List = [event for event in calDict['events'] if event.startDatetime.date() == today]
+        return calList
 
-        # Insert month header and battery icon
-        month_name = str(calDict['today'].month)
-        battLevel = calDict['batteryLevel']
+    def get_batt_text(self, batteryDisplayMode, battLevel):
+        # name of the battery icon to show, matching the classes in styles.css
         battText = 'batteryHide'
-
         if batteryDisplayMode == 1:
             battText = f'battery{min(int(battLevel // 20) * 20, 80)}'
         elif batteryDisplayMode == 2 and battLevel < 20.0:
             battText = 'battery0'
+        return battText
+
+    def process_inputs(self, calDict):
+        """
+        Generate the calendar HTML based on the input dictionary, then render it to images.
+        """
+        with self.tracer.stage('html_build'):
+            self.build_html(calDict)
+
+        # Render HTML to images
+        calBlackImage, calRedImage = self.get_screenshot()
+        return calBlackImage, calRedImage
+
+    def build_html(self, calDict):
+        """
+        Fill in the calendar HTML template from the input dictionary, and write it to calendar.html.
+        """
+        # Retrieve calendar configuration
+        maxEventsPerDay = calDict['maxEventsPerDay']
+        batteryDisplayMode = calDict['batteryDisplayMode']
+        dayOfWeekText = calDict['dayOfWeekText']
+        weekStartDay = calDict['weekStartDay']
+        is24hour = calDict['is24hour']
+
+        calList = self.get_cal_list(calDict)
+
+        calendar_template = self.calendarTemplate
+
+        # Insert month header and battery icon
+        month_name = str(calDict['today'].month)
+        battText = self.get_batt_text(batteryDisplayMode, calDict['batteryLevel'])
 
         # Populate day of week and events
         cal_days_of_week = ''.join(
@@ -133,7 +190,7 @@ class RenderHelper:
             dayOfMonth = currDate.day
             cal_events_text += f'<li><div class="date{" text-muted" if currDate.month != calDict["today"].month else ""}">{dayOfMonth}</div>\n'
             for j, event in enumerate(day_events[:maxEventsPerDay]):
-                cal_events_text += f'<div class="event{" text-muted" if currDate.month != calDict["today"].month else ""}">{event["summary"]}</div>\n'
+                cal_events_text += f'<div class="event{" text-muted" if currDate.month != calDict["today"].month else ""}">{event.summary}</div>\n'
             if len(day_events) > maxEventsPerDay:
                 cal_events_text += f'<div class="event text-muted">{len(day_events) - maxEventsPerDay} more</div>\n'
             cal_events_text += '</li>\n'
@@ -141,16 +198,13 @@ class RenderHelper:
         # Generate HTML for today's events
         today_events_text = ''
         for event in self.TodayEvent_List:
-            today_events_text += f'<div class="event">{event["summary"]}</div>\n'
+            today_events_text += f'<div class="event">{event.summary}</div>\n'
 
         # Write calendar HTML
-        with open(self.currPath + '/calendar.html', 'w') as htmlFile:
-            htmlFile.write(calendar_template.format(
-                TodayEvent=today_events_text, battText=battText, dayOfWeek=cal_days_of_week, events=cal_events_text))
+        calendar_html = calendar_template.format(
+            TodayEvent=today_events_text, battText=battText, dayOfWeek=cal_days_of_week, events=cal_events_text)
+        with open(self.htmlFile, 'w') as htmlFile:
+            htmlFile.write(calendar_html)
          
         self.logger.info("Today's events: {today_events_text}")   
-
-
-        # Render HTML to images
-        calBlackImage, calRedImage = self.get_screenshot()
-        return calBlackImage, calRedImage
+        return calendar_html
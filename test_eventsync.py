@@ -0,0 +1,89 @@
+import datetime as dt
+import tempfile
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from pytz import timezone
+from gcal.eventstore import EventStore
+from gcal.gcal import GcalHelper
+
+TZ = timezone('America/New_York')
+START = TZ.localize(dt.datetime(2024, 12, 1))
+END = TZ.localize(dt.datetime(2025, 1, 4, 23, 59, 59))
+
+
+def item(eventId, day, summary='Chores', status='confirmed'):
+    start = dt.datetime(2024, 12, day, 9, 0).isoformat() + '-05:00'
+    end = dt.datetime(2024, 12, day, 10, 0).isoformat() + '-05:00'
+    return {'id': eventId, 'status': status, 'summary': summary, 'start': {'dateTime': start},
+            'end': {'dateTime': end}, 'updated': '2024-11-01T00:00:00Z'}
+
+
+class FakeCalendar:
+    # stands in for events().list: answers full syncs with pages, sync tokens with changes or 410 Gone
+    def __init__(self, pages, changes=None, isExpired=False):
+        self.pages = pages
+        self.changes = changes or []
+        self.isExpired = isExpired
+        self.requests = []
+
+    def list_event_pages(self, cal, **kwargs):
+        self.requests.append(kwargs)
+        if 'syncToken' in kwargs:
+            if self.isExpired:
+                raise HttpError(httplib2.Response({'status': 410}), b'Sync token is no longer valid')
+            yield {'items': self.changes, 'nextSyncToken': 'token2'}
+            return
+        for page in self.pages[:-1]:
+            yield {'items': page, 'nextPageToken': 'next'}
+        yield {'items': self.pages[-1], 'nextSyncToken': 'token1'}
+
+
+def sync(folder, calendar, startDatetime=START, endDatetime=END):
+    helper = GcalHelper(1, Credentials(token='test'))
+    helper.currPath = folder
+    helper.list_event_pages = calendar.list_event_pages
+    return helper.sync_events(['primary'], startDatetime, endDatetime, TZ, 24)
+
+
+def test_sync_applies_cancelled_events_and_falls_back_on_410():
+    folder = tempfile.mkdtemp()
+    first = FakeCalendar([[item('a', 2), item('b', 3)], [item('c', 4)]])
+    assert [event.summary for event in sync(folder, first)] == ['Chores'] * 3
+    assert 'timeMax' in first.requests[0] and 'syncToken' not in first.requests[0]
+
+    # an incremental sync removes cancelled events and replaces changed ones
+    second = FakeCalendar([], changes=[item('b', 3, status='cancelled'), item('c', 4, summary='Laundry')])
+    events = sync(folder, second)
+    assert second.requests == [{'syncToken': 'token1'}]
+    assert [event.summary for event in events] == ['Chores', 'Laundry']
+
+    # an expired token is answered by a full sync that replaces the whole store
+    third = FakeCalendar([[item('d', 5)]], isExpired=True)
+    events = sync(folder, third)
+    assert [request.get('syncToken') for request in third.requests] == ['token2', None]
+    assert [event.startDatetime.day for event in events] == [5]
+    assert EventStore(folder + '/event_store.json').get('primary')['syncToken'] == 'token1'
+
+
+def test_store_drops_past_events_and_resyncs_outside_the_window():
+    folder = tempfile.mkdtemp()
+    sync(folder, FakeCalendar([[item('a', 2), item('b', 20)]]))
+
+    # a week later the event on the 2nd has ended and is pruned, and the changes are still fetched incrementally
+    later = FakeCalendar([], changes=[])
+    events = sync(folder, later, START + dt.timedelta(days=7), END + dt.timedelta(days=7))
+    assert later.requests == [{'syncToken': 'token1'}]
+    assert [event.startDatetime.day for event in events] == [20]
+    assert list(EventStore(folder + '/event_store.json').get('primary')['events']) == ['b']
+
+    # once the window has moved past the end of the last full sync, it is synced in full again
+    muchLater = FakeCalendar([[item('c', 21)]])
+    sync(folder, muchLater, START + dt.timedelta(weeks=10), END + dt.timedelta(weeks=10))
+    assert 'syncToken' not in muchLater.requests[0]
+
+
+if __name__ == '__main__':
+    test_sync_applies_cancelled_events_and_falls_back_on_410()
+    test_store_drops_past_events_and_resyncs_outside_the_window()
+    print("Incremental sync handles cancelled events, expired tokens and past events.")
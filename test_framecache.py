@@ -0,0 +1,57 @@
+import tempfile
+from display.framecache import FrameCache, MAX_DIRTY_RECTS, BAND_GAP_ROWS
+
+WIDTH = 800
+HEIGHT = 480
+ROW_BYTES = WIDTH // 8
+
+
+def frame_cache(frame):
+    frameCache = FrameCache(tempfile.mkdtemp() + '/last_frame')
+    frameCache.save(frame)
+    return frameCache
+
+
+def with_pixels(frame, *pixels):
+    frame = bytearray(frame)
+    for x, y in pixels:
+        frame[y * ROW_BYTES + x // 8] ^= 0x80 >> (x % 8)
+    return bytes(frame)
+
+
+def test_dirty_rects_cover_the_changed_bytes():
+    blank = bytes(ROW_BYTES * HEIGHT)
+    assert FrameCache(tempfile.mkdtemp() + '/last_frame').get_dirty_rects(blank, WIDTH, HEIGHT) is None
+    frameCache = frame_cache(blank)
+    assert frameCache.get_dirty_rects(blank, WIDTH, HEIGHT) == []
+
+    # a single pixel is widened to its whole byte
+    assert frameCache.get_dirty_rects(with_pixels(blank, (13, 100)), WIDTH, HEIGHT) == [(8, 100, 16, 101)]
+    # rows closer than BAND_GAP_ROWS form one band, spanning the changed bytes of all its rows
+    close = with_pixels(blank, (13, 100), (700, 100 + BAND_GAP_ROWS))
+    assert frameCache.get_dirty_rects(close, WIDTH, HEIGHT) == [(8, 100, 704, 101 + BAND_GAP_ROWS)]
+    # rows further apart are separate bands
+    apart = with_pixels(blank, (13, 100), (700, 101 + BAND_GAP_ROWS))
+    assert frameCache.get_dirty_rects(apart, WIDTH, HEIGHT) == [(8, 100, 16, 101), (696, 101 + BAND_GAP_ROWS,
+                                                                                    704, 102 + BAND_GAP_ROWS)]
+
+
+def test_dirty_rects_merge_many_bands_and_give_up_on_large_changes():
+    blank = bytes(ROW_BYTES * HEIGHT)
+    frameCache = frame_cache(blank)
+    rows = [y * (BAND_GAP_ROWS + 2) for y in range(MAX_DIRTY_RECTS + 1)]
+    # more than MAX_DIRTY_RECTS bands are refreshed as their bounding rectangle
+    scattered = with_pixels(blank, *((8 + y, y) for y in rows))
+    xEnd = (8 + rows[-1]) // 8 * 8 + 8
+    assert frameCache.get_dirty_rects(scattered, WIDTH, HEIGHT) == [(8, 0, xEnd, rows[-1] + 1)]
+    # when that covers more than MAX_DIRTY_FRACTION of the screen, a full refresh is better
+    corners = with_pixels(blank, *((x, y) for x in (0, 799) for y in range(0, HEIGHT, BAND_GAP_ROWS * 10)))
+    assert frameCache.get_dirty_rects(corners, WIDTH, HEIGHT) is None
+    # a frame of another size cannot be compared
+    assert frameCache.get_dirty_rects(bytes(ROW_BYTES * (HEIGHT - 1)), WIDTH, HEIGHT - 1) is None
+
+
+if __name__ == '__main__':
+    test_dirty_rects_cover_the_changed_bytes()
+    test_dirty_rects_merge_many_bands_and_give_up_on_large_changes()
+    print("Dirty rectangles cover exactly the changed bytes.")
@@ -0,0 +1,51 @@
+import json
+import tempfile
+from metrics.history import RunHistory
+
+
+def stage(name, wall, background=False):
+    return {'name': name, 'wall': wall, 'background': background}
+
+
+def write_history(runs):
+    path = tempfile.mkdtemp() + '/trace.jsonl'
+    with open(path, 'w') as traceFile:
+        for run in runs:
+            traceFile.write(json.dumps(run) + '\n')
+    return path
+
+
+def test_drain_is_split_over_the_main_thread_stages():
+    # 10s runs draining 1% of 1000 mAh: the fetch overlaps render and display, and must not take a share of the drain
+    run = {'wall': 10.0, 'batteryStart': 80.0, 'batteryEnd': 79.0, 'refreshed': 'full',
+           'stages': [stage('fetch', 6.0, True), stage('render', 2.0), stage('display', 6.0),
+                      stage('battery_read', 1.0), stage('busy_wait', 5.0)]}
+    history = RunHistory(write_history([dict(run, start='2024-12-01T06:00:00+00:00'),
+                                        dict(run, start='2024-12-02T06:00:00+00:00', batteryStart=78.5,
+                                             batteryEnd=77.5)]), capacityMah=1000)
+
+    stageEnergy, backgroundSeconds, runCount = history.get_stage_energy()
+    assert runCount == 2
+    assert {name: round(energy, 6) for name, (energy, _) in stageEnergy.items()} == {
+        'render': 2.0, 'display': 6.0, 'battery_read': 1.0, 'other': 1.0}
+    assert sum(energy for energy, _ in stageEnergy.values()) == 10.0
+    assert backgroundSeconds == {'fetch': 6.0}
+
+    report = history.report()
+    assert 'full refresh        2 runs    10.00 mAh per run' in report
+    assert 'Standby between runs: 5.00 mAh' in report
+    assert 'In background threads, overlapping the stages above:\nfetch                     6.00' in report
+
+
+def test_traces_without_the_background_flag_use_the_known_background_stages():
+    run = {'start': '2024-12-01T06:00:00+00:00', 'wall': 4.0, 'batteryStart': 50.0, 'batteryEnd': 49.0,
+           'stages': [{'name': 'fetch', 'wall': 3.0}, {'name': 'display', 'wall': 4.0}]}
+    stageEnergy, backgroundSeconds, _ = RunHistory(write_history([run]), capacityMah=100).get_stage_energy()
+    assert stageEnergy == {'display': (1.0, 4.0), 'other': (0.0, 0.0)}
+    assert backgroundSeconds == {'fetch': 3.0}
+
+
+if __name__ == '__main__':
+    test_drain_is_split_over_the_main_thread_stages()
+    test_traces_without_the_background_flag_use_the_known_background_stages()
+    print("Battery drain is split over the main-thread stages of each run.")
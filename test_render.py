@@ -0,0 +1,54 @@
+import random
+from PIL import Image, ImageDraw
+from render.render import RenderHelper
+
+
+def split_colours_reference(img):
+    # The original per-pixel loop from RenderHelper.get_screenshot, kept as the reference output
+    redimg = img.copy()
+    rpixels = redimg.load()
+    blackimg = img.copy()
+    bpixels = blackimg.load()
+    for i in range(redimg.size[0]):
+        for j in range(redimg.size[1]):
+            if rpixels[i, j][0] <= rpixels[i, j][1] and rpixels[i, j][0] <= rpixels[i, j][2]:  # If not red
+                rpixels[i, j] = (255, 255, 255)
+            elif bpixels[i, j][0] > bpixels[i, j][1] and bpixels[i, j][0] > bpixels[i, j][2]:  # If red
+                bpixels[i, j] = (255, 255, 255)
+    return blackimg, redimg
+
+
+def sample_renders():
+    rng = random.Random(2024)
+
+    # Random noise hits every combination of channel orderings, including ties
+    noise = Image.frombytes('RGB', (64, 48), bytes(rng.randrange(0, 256, 17) for _ in range(64 * 48 * 3)))
+    yield noise
+    yield noise.convert('RGBA')
+
+    # Something shaped like the calendar: black text, grey muted days and a red "today" box on white
+    cal = Image.new('RGB', (200, 120), (255, 255, 255))
+    draw = ImageDraw.Draw(cal)
+    for week in range(5):
+        for day in range(7):
+            x, y = day * 28, week * 24
+            colour = (108, 117, 125) if week == 4 else (33, 37, 41)
+            draw.text((x + 4, y + 2), str(week * 7 + day + 1), fill=colour)
+    draw.rectangle((58, 26, 82, 46), outline=(220, 53, 69), width=2)
+    draw.ellipse((120, 60, 150, 90), fill=(220, 53, 69))
+    yield cal
+
+
+def test_split_colours_matches_reference():
+    helper = RenderHelper(800, 480, 0)
+    for img in sample_renders():
+        blackimg, redimg = helper.split_colours(img)
+        refBlackimg, refRedimg = split_colours_reference(img)
+        assert blackimg.mode == refBlackimg.mode and redimg.mode == refRedimg.mode
+        assert blackimg.tobytes() == refBlackimg.tobytes()
+        assert redimg.tobytes() == refRedimg.tobytes()
+
+
+if __name__ == '__main__':
+    test_split_colours_matches_reference()
+    print("Vectorised colour split matches the reference loop.")
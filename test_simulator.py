@@ -0,0 +1,84 @@
+import random
+from PIL import Image, ImageDraw
+from display import epdconfig
+from display.epd7in5_V2 import EPD, INVERT_TABLE
+
+epdconfig.set_backend('simulator')
+
+
+def sample_frame(seed):
+    rng = random.Random(seed)
+    img = Image.new('1', (800, 480), 1)
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randrange(780), rng.randrange(460)
+        draw.rectangle((x, y, x + rng.randrange(4, 120), y + rng.randrange(4, 60)), fill=0)
+    return img
+
+
+def test_simulator_shows_what_the_driver_sent():
+    simulator = epdconfig.get_implementation()
+    epd = EPD()
+    first = sample_frame(1)
+    epd.init()
+    epd.Clear()
+    assert simulator.get_image().getextrema() == (255, 255)
+    epd.display(epd.getbuffer(first))
+    assert simulator.get_image().tobytes() == first.convert('L').tobytes()
+
+    # A partial refresh only changes its window, and uses the inverted data polarity of init_part
+    second = sample_frame(2)
+    box = (96, 40, 304, 200)
+    expected = first.copy()
+    expected.paste(second.crop(box), box)
+    epd.init_part()
+    epd.display_Partial(epd.getbuffer(second), *box)
+    assert simulator.get_image().tobytes() == expected.convert('L').tobytes()
+
+    epd.sleep()
+    stats = simulator.get_stats()
+    assert stats['refreshes'] == {'full': 2, 'partial': 1}
+    assert stats['busySeconds'] > 0 and stats['spiSeconds'] > 0
+
+
+def test_partial_refresh_crops_the_window_and_restores_the_old_frame():
+    simulator = epdconfig.get_implementation()
+    epd = EPD()
+    first = epd.getbuffer(sample_frame(3))
+    second = epd.getbuffer(sample_frame(4))
+    box = (100, 33, 301, 97)  # widened to whole bytes, x 96 to 304, i.e. bytes 12 to 38 of each 100 byte row
+    window = b''.join(second[y * 100 + 12:y * 100 + 38] for y in range(33, 97))
+    oldWindow = b''.join(first[y * 100 + 12:y * 100 + 38] for y in range(33, 97))
+
+    # the full frame is cropped to the same bytes as the packed window, which init_part's polarity inverts
+    epd.init_part()
+    epd.display_Partial(window, *box)
+    epd.display_Partial(second, *box)
+    simulator.finish_command()
+    sent = [bytes(data) for command, data in simulator.commands if command == 0x13][-2:]
+    assert sent == [window.translate(INVERT_TABLE)] * 2
+
+    # the frame on screen goes to the old-data RAM in the same polarity, since powering off the panel cleared it
+    epd.display_Partial(second, *box, first)
+    simulator.finish_command()
+    expected = oldWindow.translate(INVERT_TABLE)
+    assert bytes([data for command, data in simulator.commands if command == 0x10][-1]) == expected
+    assert b''.join(simulator.oldRam[y * 100 + 12:y * 100 + 38] for y in range(33, 97)) == expected
+
+
+def test_simulator_shows_4gray_levels():
+    simulator = epdconfig.get_implementation()
+    epd = EPD()
+    img = Image.new('L', (800, 480))
+    for i, gray in enumerate((0x00, 0x80, 0xC0, 0xFF)):
+        img.paste(gray, (i * 200, 0, i * 200 + 200, 480))
+    epd.init_4Gray()
+    epd.display_4Gray(epd.getbuffer_4Gray(img))
+    assert simulator.get_image().tobytes() == img.tobytes()
+
+
+if __name__ == '__main__':
+    test_simulator_shows_what_the_driver_sent()
+    test_partial_refresh_crops_the_window_and_restores_the_old_frame()
+    test_simulator_shows_4gray_levels()
+    print("The simulated panel shows the frames sent by the driver.")
@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# modules that must only be imported by the stage that needs them, never when maginkcal starts
+DEFERRED_MODULES = ('googleapiclient', 'google', 'google_auth_oauthlib', 'httplib2', 'imgkit', 'PIL', 'pytz',
+                    'spidev', 'gpiozero')
+DEFAULT_BUDGET_MS = 300
+
+
+def import_times(module):
+    # run a fresh interpreter with -X importtime and return {module: cumulative microseconds}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times.setdefault(name.strip(), int(cumulative))
+    return times
+
+
+def test_startup_within_budget():
+    with open(os.path.join(ROOT, 'config.json'), 'r') as configFile:
+        budgetMs = json.load(configFile).get('importBudgetMs', DEFAULT_BUDGET_MS)
+    times = import_times('maginkcal')
+
+    eager = {name.split('.')[0] for name in times} & set(DEFERRED_MODULES)
+    assert not eager, 'imported at startup: {}'.format(', '.join(sorted(eager)))
+    importMs = times['maginkcal'] / 1000
+    assert importMs <= budgetMs, 'importing maginkcal took {:.0f}ms, the budget is {}ms'.format(importMs, budgetMs)
+
+
+if __name__ == '__main__':
+    test_startup_within_budget()
+    print("maginkcal imports within budget: {:.0f}ms".format(import_times('maginkcal')['maginkcal'] / 1000))